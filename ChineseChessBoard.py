@@ -1,63 +1,482 @@
 from GameInterface import GameInterface
 import random
 
+# 棋子编码: 红方为正数, 黑方为负数, 空位为 0
+EMPTY = 0
+ROOK, KNIGHT, BISON, ADVISOR, KING, CANNON, PAWN = range(1, 8)
+
+PIECE_TO_CHAR = {
+    EMPTY: '_',
+    ROOK: 'R', KNIGHT: 'N', BISON: 'B', ADVISOR: 'A', KING: 'K', CANNON: 'C', PAWN: 'P',
+    -ROOK: 'r', -KNIGHT: 'n', -BISON: 'b', -ADVISOR: 'a', -KING: 'k', -CANNON: 'c', -PAWN: 'p',
+}
+CHAR_TO_PIECE = {char: piece for piece, char in PIECE_TO_CHAR.items()}
+
+# 这么多步没有吃子判和
+MAX_STEPS_NO_CAPTURE = 60
+
+INITIAL_BOARD = [
+    ['r', 'n', 'b', 'a', 'k', 'a', 'b', 'n', 'r'],
+    ['_', '_', '_', '_', '_', '_', '_', '_', '_'],
+    ['_', 'c', '_', '_', '_', '_', '_', 'c', '_'],
+    ['p', '_', 'p', '_', 'p', '_', 'p', '_', 'p'],
+    ['_', '_', '_', '_', '_', '_', '_', '_', '_'],
+    ['_', '_', '_', '_', '_', '_', '_', '_', '_'],
+    ['P', '_', 'P', '_', 'P', '_', 'P', '_', 'P'],
+    ['_', 'C', '_', '_', '_', '_', '_', 'C', '_'],
+    ['_', '_', '_', '_', '_', '_', '_', '_', '_'],
+    ['R', 'N', 'B', 'A', 'K', 'A', 'B', 'N', 'R']
+]
+INITIAL_SQUARES = [CHAR_TO_PIECE[piece] for row in INITIAL_BOARD for piece in row]
+
+# 方格编号 sq = x * 9 + y 与坐标 (x, y) 的对应关系
+SQUARE_TO_POS = [(sq // 9, sq % 9) for sq in range(90)]
+# 左右翻转: 第 y 列换到第 8 - y 列
+MIRROR_SQUARE = [(sq // 9) * 9 + 8 - sq % 9 for sq in range(90)]
+
+# Zobrist 随机数, 用固定种子保证不同进程得到相同的局面键
+_zobrist_random = random.Random(20230730)
+# 按棋子编码索引, 黑方的负数编码正好落在列表尾部
+ZOBRIST_PIECE_KEYS = [[0] * 90] + [[_zobrist_random.getrandbits(64) for _ in range(90)] for _ in range(14)]
+ZOBRIST_RED_TURN_KEY = _zobrist_random.getrandbits(64)
+
+
+def compute_zobrist(squares):
+    key = 0
+    for sq, piece in enumerate(squares):
+        if piece != EMPTY:
+            key ^= ZOBRIST_PIECE_KEYS[piece][sq]
+    return key
+
+
+def to_square(position):
+    x, y = position
+    return x * 9 + y
+
+
+# 走法用一个整数表示: move = 起点方格 * 90 + 终点方格
+def encode_move(src, dst):
+    return src * 90 + dst
+
+
+def decode_move(move):
+    # 整数走法 -> ((x, y), (x, y))
+    return SQUARE_TO_POS[move // 90], SQUARE_TO_POS[move % 90]
+
+
+INITIAL_ZOBRIST = compute_zobrist(INITIAL_SQUARES)
+
+
+def _on_board(x, y):
+    return 0 <= x < 10 and 0 <= y < 9
+
+
+def _in_palace(x, y, is_black):
+    if is_black:
+        return 0 <= x <= 2 and 3 <= y <= 5
+    return 7 <= x <= 9 and 3 <= y <= 5
+
+
+def _build_move_tables():
+    # 走法表在导入时生成一次, 按 [是否黑方][方格] 或 [方格] 索引
+    king_moves = ([], [])
+    advisor_moves = ([], [])
+    bison_moves = ([], [])
+    pawn_moves = ([], [])
+    knight_moves = []
+    rays = []
+
+    for sq in range(90):
+        x, y = SQUARE_TO_POS[sq]
+
+        for is_black in (False, True):
+            # 帅/将和士/仕只能在九宫内走
+            king_moves[is_black].append([
+                nx * 9 + ny for nx, ny in ((x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y))
+                if _on_board(nx, ny) and _in_palace(nx, ny, is_black)])
+            advisor_moves[is_black].append([
+                nx * 9 + ny for nx, ny in ((x - 1, y - 1), (x - 1, y + 1), (x + 1, y - 1), (x + 1, y + 1))
+                if _on_board(nx, ny) and _in_palace(nx, ny, is_black)])
+
+            # 相/象不能过河, 记录塞象眼的方格
+            bison_moves[is_black].append([
+                (nx * 9 + ny, (x + dx // 2) * 9 + y + dy // 2)
+                for dx, dy in ((-2, -2), (-2, 2), (2, -2), (2, 2))
+                for nx, ny in ((x + dx, y + dy),)
+                if _on_board(nx, ny) and (nx <= 4 if is_black else nx >= 5)])
+
+            # 兵/卒过河后可以横走
+            if is_black:
+                directions = [(1, 0)] + ([(0, 1), (0, -1)] if x >= 5 else [])
+            else:
+                directions = [(-1, 0)] + ([(0, 1), (0, -1)] if x <= 4 else [])
+            pawn_moves[is_black].append([
+                (x + dx) * 9 + y + dy for dx, dy in directions if _on_board(x + dx, y + dy)])
+
+        # 马走日, 记录蹩马腿的方格
+        targets = []
+        for dx, dy in ((-1, -2), (1, -2), (-1, 2), (1, 2), (-2, -1), (-2, 1), (2, -1), (2, 1)):
+            nx, ny = x + dx, y + dy
+            if _on_board(nx, ny):
+                if dx == 2 or dx == -2:
+                    leg = (x + dx // 2) * 9 + y
+                else:
+                    leg = x * 9 + y + dy // 2
+                targets.append((nx * 9 + ny, leg))
+        knight_moves.append(targets)
+
+        # 车/炮的四条射线, 顺序为右、下、左、上
+        square_rays = []
+        for dx, dy in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+            ray = []
+            nx, ny = x + dx, y + dy
+            while _on_board(nx, ny):
+                ray.append(nx * 9 + ny)
+                nx, ny = nx + dx, ny + dy
+            square_rays.append(ray)
+        rays.append(square_rays)
+
+    return king_moves, advisor_moves, bison_moves, pawn_moves, knight_moves, rays
+
+
+KING_MOVES, ADVISOR_MOVES, BISON_MOVES, PAWN_MOVES, KNIGHT_MOVES, RAYS = _build_move_tables()
+RAY_RIGHT, RAY_DOWN, RAY_LEFT, RAY_UP = range(4)
+
+
+def _build_attack_tables():
+    # 反查表: 哪些方格上的马/象/士/兵可以走到给定方格
+    knight_attacks = [[] for _ in range(90)]
+    for origin in range(90):
+        for dst, leg in KNIGHT_MOVES[origin]:
+            knight_attacks[dst].append((origin, leg))
+
+    bison_attacks = ([[] for _ in range(90)], [[] for _ in range(90)])
+    advisor_attacks = ([[] for _ in range(90)], [[] for _ in range(90)])
+    pawn_attacks = ([[] for _ in range(90)], [[] for _ in range(90)])
+    for is_black in (False, True):
+        for origin in range(90):
+            for dst, eye in BISON_MOVES[is_black][origin]:
+                bison_attacks[is_black][dst].append((origin, eye))
+            for dst in ADVISOR_MOVES[is_black][origin]:
+                advisor_attacks[is_black][dst].append(origin)
+            for dst in PAWN_MOVES[is_black][origin]:
+                pawn_attacks[is_black][dst].append(origin)
+
+    return knight_attacks, bison_attacks, advisor_attacks, pawn_attacks
+
+
+KNIGHT_ATTACKS, BISON_ATTACKS, ADVISOR_ATTACKS, PAWN_ATTACKS = _build_attack_tables()
+
+
+def find_king_squares(squares):
+    # 返回 [帅的位置, 将的位置], 不在棋盘上时为 None
+    king_squares = [None, None]
+    for sq, piece in enumerate(squares):
+        if piece == KING:
+            king_squares[0] = sq
+        elif piece == -KING:
+            king_squares[1] = sq
+    return king_squares
+
+
+def find_pieces(squares):
+    # 返回 [红方 {方格: 棋子}, 黑方 {方格: 棋子}]
+    pieces = [{}, {}]
+    for sq, piece in enumerate(squares):
+        if piece != EMPTY:
+            pieces[piece < 0][sq] = piece
+    return pieces
+
+
+INITIAL_PIECES = find_pieces(INITIAL_SQUARES)
+
+
+class _BoardRowView:
+    # board.board[x] 返回的行视图, 读写都落到扁平数组上
+    __slots__ = ('_chess_board', '_offset')
+
+    def __init__(self, chess_board, x):
+        self._chess_board = chess_board
+        self._offset = x * 9
+
+    def __len__(self):
+        return 9
+
+    def __getitem__(self, y):
+        if not 0 <= y < 9:
+            raise IndexError('column index out of range')
+        return PIECE_TO_CHAR[self._chess_board.squares[self._offset + y]]
+
+    def __setitem__(self, y, piece):
+        if not 0 <= y < 9:
+            raise IndexError('column index out of range')
+        self._chess_board.set_square(self._offset + y, CHAR_TO_PIECE.get(piece, EMPTY))
+
+    def __iter__(self):
+        squares = self._chess_board.squares
+        return (PIECE_TO_CHAR[squares[sq]] for sq in range(self._offset, self._offset + 9))
+
+    def copy(self):
+        return list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class _BoardView:
+    # 兼容旧的 board.board[x][y] 字符接口, 供界面、调试器和棋谱使用
+    __slots__ = ('_chess_board',)
+
+    def __init__(self, chess_board):
+        self._chess_board = chess_board
+
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, x):
+        if not 0 <= x < 10:
+            raise IndexError('row index out of range')
+        return _BoardRowView(self._chess_board, x)
+
+    def __iter__(self):
+        return (_BoardRowView(self._chess_board, x) for x in range(10))
+
+    def __repr__(self):
+        return repr([list(row) for row in self])
+
 
 class ChineseChessBoard(GameInterface):
     def __init__(self):
-        self.board = [
-            ['r', 'n', 'b', 'a', 'k', 'a', 'b', 'n', 'r'],
-            ['_', '_', '_', '_', '_', '_', '_', '_', '_'],
-            ['_', 'c', '_', '_', '_', '_', '_', 'c', '_'],
-            ['p', '_', 'p', '_', 'p', '_', 'p', '_', 'p'],
-            ['_', '_', '_', '_', '_', '_', '_', '_', '_'],
-            ['_', '_', '_', '_', '_', '_', '_', '_', '_'],
-            ['P', '_', 'P', '_', 'P', '_', 'P', '_', 'P'],
-            ['_', 'C', '_', '_', '_', '_', '_', 'C', '_'],
-            ['_', '_', '_', '_', '_', '_', '_', '_', '_'],
-            ['R', 'N', 'B', 'A', 'K', 'A', 'B', 'N', 'R']
-        ]
+        # 90 个方格的扁平数组, 下标为 x * 9 + y
+        self.squares = INITIAL_SQUARES.copy()
         self.is_red_turn = False
         self.is_game_over = False
         self.num_steps_no_capture = 0
         self.winner = None
+        # 棋子部分的 Zobrist 键, 走子时增量更新
+        self._zobrist = INITIAL_ZOBRIST
+        # [帅的位置, 将的位置], 走子时增量更新
+        self._king_squares = [INITIAL_SQUARES.index(KING), INITIAL_SQUARES.index(-KING)]
+        # 双方在棋盘上的棋子, 走子和吃子时增量更新, 走法生成只遍历活着的棋子
+        self._pieces = [INITIAL_PIECES[0].copy(), INITIAL_PIECES[1].copy()]
+        # 上一次将死判断的局面键和结果
+        self._checkmate_memo = (None, False)
+        # 上一次判断走子方是否被将军的局面键和结果
+        self._check_memo = (None, False)
+        # 走过的局面, 每一项是 (局面键, 当时走子方是否被将军, 更早的记录), copy 之后共享前面的部分
+        self._history = None
+        # make_move 的悔棋记录
+        self._undo_stack = []
+
+    @property
+    def board(self):
+        return _BoardView(self)
+
+    @board.setter
+    def board(self, rows):
+        self._set_squares([CHAR_TO_PIECE.get(piece, EMPTY) for row in rows for piece in row])
+
+    def _set_squares(self, squares):
+        self.squares = squares
+        self._zobrist = compute_zobrist(self.squares)
+        self._king_squares = find_king_squares(self.squares)
+        self._pieces = find_pieces(self.squares)
+        self._history = None
+        self._undo_stack = []
+
+    @property
+    def zobrist_key(self):
+        # 64 位局面键, 包含走子方, 可以直接作为字典的键
+        if self.is_red_turn:
+            return self._zobrist ^ ZOBRIST_RED_TURN_KEY
+        return self._zobrist
+
+    def mirrored_zobrist_key(self):
+        # 左右翻转之后的局面的 zobrist_key
+        key = ZOBRIST_RED_TURN_KEY if self.is_red_turn else 0
+        for pieces in self._pieces:
+            for sq, piece in pieces.items():
+                key ^= ZOBRIST_PIECE_KEYS[piece][MIRROR_SQUARE[sq]]
+        return key
+
+    def key_after_move(self, start_pos, end_pos):
+        # make_move(start_pos, end_pos) 之后的 zobrist_key, 不用真的走子
+        src = start_pos[0] * 9 + start_pos[1]
+        dst = end_pos[0] * 9 + end_pos[1]
+        piece_keys = ZOBRIST_PIECE_KEYS[self.squares[src]]
+        key = self._zobrist ^ piece_keys[src] ^ piece_keys[dst] ^ ZOBRIST_PIECE_KEYS[self.squares[dst]][dst]
+        if not self.is_red_turn:
+            return key ^ ZOBRIST_RED_TURN_KEY
+        return key
+
+    def set_square(self, sq, piece):
+        old_piece = self.squares[sq]
+        self.squares[sq] = piece
+        self._zobrist ^= ZOBRIST_PIECE_KEYS[old_piece][sq] ^ ZOBRIST_PIECE_KEYS[piece][sq]
+        if old_piece != EMPTY:
+            del self._pieces[old_piece < 0][sq]
+        if piece != EMPTY:
+            self._pieces[piece < 0][sq] = piece
+        if abs(old_piece) == KING or abs(piece) == KING:
+            self._king_squares = find_king_squares(self.squares)
 
     def encode(self):
-        return "".join(["".join(row) for row in self.board])
+        return "".join([PIECE_TO_CHAR[piece] for piece in self.squares])
+
+    @staticmethod
+    def decode(encoded, is_red_turn=False):
+        # encode() 的逆操作, 走子方需要另外给出
+        chess_board = ChineseChessBoard()
+        chess_board.board = [encoded[x * 9:x * 9 + 9] for x in range(10)]
+        chess_board.is_red_turn = is_red_turn
+        return chess_board
+
+    @staticmethod
+    def from_squares(squares, is_red_turn=False):
+        # 由 90 个棋子编码建棋盘, 残局库枚举局面时用
+        chess_board = ChineseChessBoard()
+        chess_board._set_squares(list(squares))
+        chess_board.is_red_turn = is_red_turn
+        return chess_board
+
+    def material_key(self):
+        # 子力, 如 'KRvKAA': 红方在前, 黑方在后, 都用大写, 按棋子编码排序
+        red = sorted(self._pieces[0].values())
+        black = sorted(-piece for piece in self._pieces[1].values())
+        return (''.join(PIECE_TO_CHAR[piece] for piece in red if piece != KING)
+                .join(('K', 'vK')) + ''.join(PIECE_TO_CHAR[piece] for piece in black if piece != KING))
+
+    def probe_tablebase(self, tablebase):
+        # 残局库里的结果, 见 tablebase.Tablebase.probe
+        return tablebase.probe(self)
 
     def get_all_piece_position(self):
         piece_positions = {}
-        for i, row in enumerate(self.board):
-            for j, piece in enumerate(row):
-                if piece != '_':
-                    if piece not in piece_positions:
-                        piece_positions[piece] = []
-                    piece_positions[piece].append((i, j))
+        for pieces in self._pieces:
+            for sq, piece in pieces.items():
+                char = PIECE_TO_CHAR[piece]
+                if char not in piece_positions:
+                    piece_positions[char] = []
+                piece_positions[char].append(SQUARE_TO_POS[sq])
         return piece_positions
 
     def generate_next_states(self):
         next_states = []
-        for x in range(10):
-            for y in range(9):
-                piece = self.board[x][y]
-                if piece != '_' and piece.islower() != self.is_red_turn:
-                    piece_moves = self.get_piece_moves((x, y))
-                    for move in piece_moves:
-                        next_state = self.copy()
-                        next_state.move_piece((x, y), move)
-                        next_states.append((next_state, (x, y), move))
+        for src, dst in self._legal_square_moves():
+            next_state = self.copy()
+            next_state._make_move(src, dst)
+            next_states.append((next_state, SQUARE_TO_POS[src], SQUARE_TO_POS[dst]))
         return next_states
 
+    def legal_moves(self):
+        # 只返回走法 ((x, y), (x, y)), 不复制棋盘; 已经排除了走完后自己被将军的走法
+        return [(SQUARE_TO_POS[src], SQUARE_TO_POS[dst]) for src, dst in self._legal_square_moves()]
+
+    def legal_move_codes(self):
+        # 与 legal_moves 顺序相同的整数走法, 见 encode_move
+        return [src * 90 + dst for src, dst in self._legal_square_moves()]
+
+    def _legal_square_moves(self):
+        is_black = not self.is_red_turn
+        pieces = self._pieces[is_black]
+        king_sq = self._king_squares[is_black]
+        moves = []
+
+        if king_sq is None:
+            for src in pieces:
+                for dst in self._piece_targets(src):
+                    moves.append((src, dst))
+            return moves
+
+        # 被将军时逐个试走; 否则只有走将/帅和被牵制的棋子需要试走
+        if self._is_king_attacked(king_sq, is_black):
+            for src in pieces:
+                for dst in self._piece_targets(src):
+                    if self._is_safe_move(src, dst, is_black):
+                        moves.append((src, dst))
+            return moves
+
+        pinned, screens = self._pins(king_sq, is_black)
+        for src in pieces:
+            if src == king_sq or src in pinned:
+                for dst in self._piece_targets(src):
+                    if self._is_safe_move(src, dst, is_black):
+                        moves.append((src, dst))
+            elif screens:
+                for dst in self._piece_targets(src):
+                    if dst not in screens:
+                        moves.append((src, dst))
+            else:
+                for dst in self._piece_targets(src):
+                    moves.append((src, dst))
+
+        return moves
+
+    def _pins(self, king_sq, is_black):
+        # 没有被将军时的牵制信息:
+        # pinned  - 走开后可能让将/帅被车、炮、马、象或者对面的将/帅攻击的己方棋子
+        # screens - 将/帅和对方炮之间的空位, 走到那里就成了炮架
+        squares = self.squares
+        sign = 1 if is_black else -1
+        rook, cannon, king = ROOK * sign, CANNON * sign, KING * sign
+        flying_ray = RAY_DOWN if is_black else RAY_UP
+        pinned = set()
+        screens = set()
+
+        for direction, ray in enumerate(RAYS[king_sq]):
+            blockers = []
+            for sq in ray:
+                if squares[sq] != EMPTY:
+                    blockers.append(sq)
+                    if len(blockers) == 3:
+                        break
+                elif not blockers:
+                    screens.add(sq)
+
+            if not blockers or squares[blockers[0]] != cannon:
+                screens.difference_update(ray)
+            if len(blockers) < 2:
+                continue
+            first, second = squares[blockers[0]], squares[blockers[1]]
+            third = squares[blockers[2]] if len(blockers) == 3 else EMPTY
+
+            # 挪走第一个子: 第二个子变成直接攻击者, 第三个子变成隔一子的炮
+            if first * sign < 0 and (second == rook or (second == king and direction == flying_ray) or third == cannon):
+                pinned.add(blockers[0])
+            # 挪走第二个子: 第三个子变成隔一子的炮
+            if second * sign < 0 and third == cannon:
+                pinned.add(blockers[1])
+
+        # 堵着对方马腿、象眼的己方棋子
+        knight = KNIGHT * sign
+        for origin, leg in KNIGHT_ATTACKS[king_sq]:
+            if squares[origin] == knight and squares[leg] * sign < 0:
+                pinned.add(leg)
+        bison = BISON * sign
+        for origin, eye in BISON_ATTACKS[sign < 0][king_sq]:
+            if squares[origin] == bison and squares[eye] * sign < 0:
+                pinned.add(eye)
+
+        return pinned, screens
+
+    def _is_safe_move(self, src, dst, is_black):
+        # 攻击判断只读方格数组, 临时挪动两个方格即可, 不需要完整的 make/unmake
+        squares = self.squares
+        piece = squares[src]
+        target = squares[dst]
+        squares[dst] = piece
+        squares[src] = EMPTY
+        king_sq = dst if piece == KING or piece == -KING else self._king_squares[is_black]
+        is_safe = not self._is_king_attacked(king_sq, is_black)
+        squares[src] = piece
+        squares[dst] = target
+        return is_safe
+
     def random_move(self):
-        legal_moves = []
-        for x in range(10):
-            for y in range(9):
-                piece = self.board[x][y]
-                if piece != '_' and piece.isupper() == self.is_red_turn:
-                    piece_moves = self.get_piece_moves((x, y))
-                    for move in piece_moves:
-                        legal_moves.append(((x, y), move))
+        legal_moves = self._legal_square_moves()
         if legal_moves:
-            return random.choice(legal_moves)
+            src, dst = random.choice(legal_moves)
+            return SQUARE_TO_POS[src], SQUARE_TO_POS[dst]
         return None
 
     def get_final_reward(self):
@@ -71,12 +490,20 @@ class ChineseChessBoard(GameInterface):
         return None
 
     def copy(self):
-        copied_board = ChineseChessBoard()
-        copied_board.board = [row.copy() for row in self.board]
+        # 只复制局面, 悔棋记录不随之复制
+        copied_board = ChineseChessBoard.__new__(ChineseChessBoard)
+        copied_board.squares = self.squares.copy()
         copied_board.is_red_turn = self.is_red_turn
         copied_board.is_game_over = self.is_game_over
         copied_board.num_steps_no_capture = self.num_steps_no_capture
         copied_board.winner = self.winner
+        copied_board._zobrist = self._zobrist
+        copied_board._king_squares = self._king_squares.copy()
+        copied_board._pieces = [self._pieces[0].copy(), self._pieces[1].copy()]
+        copied_board._checkmate_memo = self._checkmate_memo
+        copied_board._check_memo = self._check_memo
+        copied_board._history = self._history
+        copied_board._undo_stack = []
         return copied_board
 
     def game_over(self):
@@ -88,49 +515,137 @@ class ChineseChessBoard(GameInterface):
             self.is_game_over = True
             self.winner = 'black' if self.is_red_turn else 'red'
             return True
+        # 长将判负
+        result = self.repetition_result()
+        if result == 'red' or result == 'black':
+            self.is_game_over = True
+            self.winner = result
+            return True
         return False
 
     def move_piece(self, start_pos, end_pos):
         if not self.is_game_over:
-            start_x, start_y = start_pos
-            end_x, end_y = end_pos
-            piece = self.board[start_x][start_y]
-            target = self.board[end_x][end_y]
-
             if self.is_valid_move(start_pos, end_pos):
-                self.board[end_x][end_y] = piece
-                self.board[start_x][start_y] = '_'
+                self.make_move(start_pos, end_pos)
+            elif self.squares[to_square(end_pos)] != EMPTY:
+                self.num_steps_no_capture = 0
+            else:
+                self.num_steps_no_capture += 1
 
-                if target.lower() == 'k':
-                    self.is_game_over = True
+    def make_move(self, start_pos, end_pos):
+        # 不做合法性检查的走子, 搜索可以在同一个棋盘上 make_move / unmake_move
+        self._make_move(start_pos[0] * 9 + start_pos[1], end_pos[0] * 9 + end_pos[1])
 
-                    if target.islower():
-                        self.winner = 'red'
-                    else:
-                        self.winner = 'black'
+    def _make_move(self, src, dst):
+        squares = self.squares
+        piece = squares[src]
+        target = squares[dst]
 
-                self.is_red_turn = not self.is_red_turn
+        self._undo_stack.append((src, dst, target, self.is_red_turn, self.num_steps_no_capture,
+                                 self.is_game_over, self.winner, self._zobrist))
 
-            if target != '_':
-                self.num_steps_no_capture = 0
-            else:
-                self.num_steps_no_capture += 1
+        # 记下走子前的局面, 将军与否只在判断过时才知道
+        key = self.zobrist_key
+        memo_key, in_check = self._check_memo
+        self._history = (key, in_check if memo_key == key else None, self._history)
+
+        squares[dst] = piece
+        squares[src] = EMPTY
+
+        piece_keys = ZOBRIST_PIECE_KEYS[piece]
+        self._zobrist ^= piece_keys[src] ^ piece_keys[dst] ^ ZOBRIST_PIECE_KEYS[target][dst]
+
+        if piece == KING or piece == -KING:
+            self._king_squares[piece < 0] = dst
 
-    def is_draw(self, max_steps_no_capture=60):
-        return self.num_steps_no_capture >= max_steps_no_capture
+        pieces = self._pieces[piece < 0]
+        del pieces[src]
+        pieces[dst] = piece
+
+        if target != EMPTY:
+            del self._pieces[target < 0][dst]
+            self.num_steps_no_capture = 0
+            if target == KING or target == -KING:
+                self._king_squares[target < 0] = None
+                self.is_game_over = True
+                self.winner = 'red' if target < 0 else 'black'
+        else:
+            self.num_steps_no_capture += 1
+
+        self.is_red_turn = not self.is_red_turn
+
+    def unmake_move(self):
+        (src, dst, target, is_red_turn, num_steps_no_capture,
+         is_game_over, winner, zobrist) = self._undo_stack.pop()
+        squares = self.squares
+        piece = squares[src] = squares[dst]
+        squares[dst] = target
+
+        if piece == KING or piece == -KING:
+            self._king_squares[piece < 0] = src
+        if target == KING or target == -KING:
+            self._king_squares[target < 0] = dst
+
+        pieces = self._pieces[piece < 0]
+        del pieces[dst]
+        pieces[src] = piece
+        if target != EMPTY:
+            self._pieces[target < 0][dst] = target
+
+        self.is_red_turn = is_red_turn
+        self.num_steps_no_capture = num_steps_no_capture
+        self.is_game_over = is_game_over
+        self.winner = winner
+        self._zobrist = zobrist
+        self._history = self._history[2]
+
+    def is_draw(self, max_steps_no_capture=MAX_STEPS_NO_CAPTURE):
+        if self.num_steps_no_capture >= max_steps_no_capture:
+            return True
+        return self.repetition_result() == 'draw'
+
+    def repetition_result(self, repetitions=3):
+        """None until the current position has occurred `repetitions` times, then 'draw',
+        or the winner ('red' / 'black') when the other side gave check on every move of the cycle."""
+        key = self.zobrist_key
+        count = 1
+        # 每个局面的走子方是否被将军, 下标 0 是当前局面, 下标 k 是 k 步之前
+        checks = [self._side_to_move_in_check()]
+        cycle_length = None
+        # 吃子之前的局面不可能重复, 只往回看 num_steps_no_capture 步
+        entry = self._history
+        for _ in range(self.num_steps_no_capture):
+            if entry is None:
+                break
+            entry_key, in_check, entry = entry
+            if entry_key == key:
+                count += 1
+                if cycle_length is None:
+                    cycle_length = len(checks)
+            checks.append(bool(in_check))
+
+        if count < repetitions:
+            return None
+
+        # 最近一次循环里, 偶数下标是当前走子方, 奇数下标是对方; 只有一方一直在将军, 这一方判负
+        cycle = checks[:cycle_length]
+        side_checked = all(cycle[0::2])
+        other_checked = all(cycle[1::2])
+        if side_checked and not other_checked:
+            return 'red' if self.is_red_turn else 'black'
+        if other_checked and not side_checked:
+            return 'black' if self.is_red_turn else 'red'
+        return 'draw'
 
     def is_valid_move(self, start_pos, end_pos):
-        start_x, start_y = start_pos
-        piece = self.board[start_x][start_y]
+        piece = self.squares[to_square(start_pos)]
 
         # 如果起始位置没有棋子，返回False
-        if piece == '_':
+        if piece == EMPTY:
             return False
 
         # 确保棋子的颜色与当前回合颜色相符
-        if self.is_red_turn and piece.islower():
-            return False
-        if not self.is_red_turn and piece.isupper():
+        if (piece > 0) != self.is_red_turn:
             return False
 
         # 获取给定棋子的所有合法走子
@@ -140,271 +655,204 @@ class ChineseChessBoard(GameInterface):
         return end_pos in legal_moves
 
     def get_piece_moves(self, position):
-        x, y = position
-        piece = self.board[x][y]
-
-        piece_type = piece.lower()
-        moves = []
-
-        if piece_type == 'k':
-            moves = self.get_piece_king_moves(position)
-        elif piece_type == 'a':
-            moves = self.get_piece_advisor_moves(position)
-        elif piece_type == 'b':
-            moves = self.get_piece_bison_moves(position)
-        elif piece_type == 'n':
-            moves = self.get_piece_knight_moves(position)
-        elif piece_type == 'r':
-            moves = self.get_piece_rook_moves(position)
-        elif piece_type == 'c':
-            moves = self.get_piece_canon_moves(position)
-        elif piece_type == 'p':
-            moves = self.get_piece_pawn_moves(position)
-
-        return moves
+        return [SQUARE_TO_POS[dst] for dst in self._piece_targets(to_square(position))]
+
+    def _piece_targets(self, sq):
+        piece = self.squares[sq]
+
+        piece_type = abs(piece)
+        targets = []
+
+        if piece_type == KING:
+            targets = self._king_targets(sq, piece)
+        elif piece_type == ADVISOR:
+            targets = self._step_targets(ADVISOR_MOVES[piece < 0][sq], piece)
+        elif piece_type == BISON:
+            targets = self._leg_targets(BISON_MOVES[piece < 0][sq], piece)
+        elif piece_type == KNIGHT:
+            targets = self._leg_targets(KNIGHT_MOVES[sq], piece)
+        elif piece_type == ROOK:
+            targets = self._rook_targets(sq, piece)
+        elif piece_type == CANNON:
+            targets = self._cannon_targets(sq, piece)
+        elif piece_type == PAWN:
+            targets = self._step_targets(PAWN_MOVES[piece < 0][sq], piece)
+
+        return targets
 
     def get_piece_king_moves(self, position):
-        x, y = position
-        piece = self.board[x][y]
-        moves = []
-
-        directions = [(0, 1), (1, 0), (0, -1), (-1, 0)]
-
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-
-            if 0 <= nx < 10 and 0 <= ny < 9:
-                # 帅/将的宫限制
-                if piece.islower() and (0 <= nx <= 2) and (3 <= ny <= 5):
-                    target = self.board[nx][ny]
-                    if target == '_' or target.isupper():
-                        moves.append((nx, ny))
-                elif piece.isupper() and (7 <= nx <= 9) and (3 <= ny <= 5):
-                    target = self.board[nx][ny]
-                    if target == '_' or target.islower():
-                        moves.append((nx, ny))
-
-                if piece == 'K' and nx == x - 1 and ny == y:
-                    # 判断将/帅之间是否隔着棋子
-                    for i in range(x - 1, -1, -1):
-                        if self.board[i][y] != '_' and self.board[i][y] != 'k':
-                            break
-                        if self.board[i][y] == 'k':
-                            moves.append((i, y))
-                            break
-
-                elif piece == 'k' and nx == x + 1 and ny == y:
-                    for i in range(x + 1, 10):
-                        if self.board[i][y] != '_' and self.board[i][y] != 'K':
-                            break
-                        if self.board[i][y] == 'K':
-                            moves.append((i, y))
-
-        return moves
+        sq = to_square(position)
+        return [SQUARE_TO_POS[dst] for dst in self._king_targets(sq, self.squares[sq])]
 
     def get_piece_advisor_moves(self, position):
-        x, y = position
-        piece = self.board[x][y]
-        moves = []
-
-        directions = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
-
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-
-            if 0 <= nx < 10 and 0 <= ny < 9:
-                # 士/仕的宫限制
-                if piece.islower() and (3 <= ny <= 5) and (0 <= nx <= 2):
-                    target = self.board[nx][ny]
-                    if target == '_' or target.isupper():
-                        moves.append((nx, ny))
-                elif piece.isupper() and (3 <= ny <= 5) and (7 <= nx <= 9):
-                    target = self.board[nx][ny]
-                    if target == '_' or target.islower():
-                        moves.append((nx, ny))
-
-        return moves
+        sq = to_square(position)
+        piece = self.squares[sq]
+        return [SQUARE_TO_POS[dst] for dst in self._step_targets(ADVISOR_MOVES[piece < 0][sq], piece)]
 
     def get_piece_bison_moves(self, position):
-        x, y = position
-        piece = self.board[x][y]
-        moves = []
+        sq = to_square(position)
+        piece = self.squares[sq]
+        return [SQUARE_TO_POS[dst] for dst in self._leg_targets(BISON_MOVES[piece < 0][sq], piece)]
 
-        directions = [(-2, -2), (-2, 2), (2, -2), (2, 2)]
-
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
+    def get_piece_rook_moves(self, position):
+        sq = to_square(position)
+        return [SQUARE_TO_POS[dst] for dst in self._rook_targets(sq, self.squares[sq])]
 
-            # 确保在棋盘内
-            if 0 <= nx < 10 and 0 <= ny < 9:
-                target = self.board[nx][ny]
-                # 没有越过河
-                if piece.islower() and (0 <= nx <= 4) or piece.isupper() and (5 <= nx <= 9):
-                    # 没有被蹩腿
-                    blocking_x, blocking_y = (x + dx // 2, y + dy // 2)
-                    blocking_piece = self.board[blocking_x][blocking_y]
-                    if blocking_piece == '_':
-                        if target == '_' or piece.islower() != target.islower():
-                            moves.append((nx, ny))
+    def get_piece_knight_moves(self, position):
+        sq = to_square(position)
+        return [SQUARE_TO_POS[dst] for dst in self._leg_targets(KNIGHT_MOVES[sq], self.squares[sq])]
 
-        return moves
+    def get_piece_canon_moves(self, position):
+        sq = to_square(position)
+        return [SQUARE_TO_POS[dst] for dst in self._cannon_targets(sq, self.squares[sq])]
 
-    def get_piece_rook_moves(self, position):
-        x, y = position
-        piece = self.board[x][y]
-        moves = []
+    def get_piece_pawn_moves(self, position):
+        sq = to_square(position)
+        piece = self.squares[sq]
+        return [SQUARE_TO_POS[dst] for dst in self._step_targets(PAWN_MOVES[piece < 0][sq], piece)]
+
+    def _step_targets(self, candidates, piece):
+        # 目标方格为空或者是对方棋子
+        squares = self.squares
+        return [dst for dst in candidates if squares[dst] * piece <= 0]
+
+    def _leg_targets(self, candidates, piece):
+        # 马腿/象眼没有被堵住
+        squares = self.squares
+        return [dst for dst, leg in candidates if squares[leg] == EMPTY and squares[dst] * piece <= 0]
+
+    def _king_targets(self, sq, piece):
+        squares = self.squares
+        targets = [dst for dst in KING_MOVES[piece < 0][sq] if squares[dst] * piece <= 0]
+
+        # 将帅照面: 同一列中间没有棋子时可以直接吃掉对方的将/帅
+        for dst in RAYS[sq][RAY_DOWN if piece < 0 else RAY_UP]:
+            target = squares[dst]
+            if target != EMPTY:
+                if target == -piece:
+                    targets.append(dst)
+                break
 
-        directions = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+        return targets
 
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
+    def _rook_targets(self, sq, piece):
+        squares = self.squares
+        targets = []
 
-            while 0 <= nx < 10 and 0 <= ny < 9:
-                target = self.board[nx][ny]
-                if target == '_':
-                    moves.append((nx, ny))
+        for ray in RAYS[sq]:
+            for dst in ray:
+                target = squares[dst]
+                if target == EMPTY:
+                    targets.append(dst)
                 else:
-                    if piece.islower() != target.islower():
-                        moves.append((nx, ny))
+                    if target * piece < 0:
+                        targets.append(dst)
                     break
 
-                nx, ny = nx + dx, ny + dy
-
-        return moves
-
-    def get_piece_knight_moves(self, position):
-        x, y = position
-        piece = self.board[x][y]
-        moves = []
-
-        offsets = [
-            (-1, -2), (1, -2), (-1, 2), (1, 2),
-            (-2, -1), (-2, 1), (2, -1), (2, 1)
-        ]
-
-        for dx, dy in offsets:
-            nx, ny = x + dx, y + dy
-
-            # 确保在棋盘内
-            if 0 <= nx < 10 and 0 <= ny < 9:
-                target = self.board[nx][ny]
-                # 没有被蹩腿
-                blocking_x, blocking_y = x, y
-                if dx == 2 or dx == -2:
-                    blocking_x = x + dx // 2
-                elif dy == 2 or dy == -2:
-                    blocking_y = y + dy // 2
-                blocking_piece = self.board[blocking_x][blocking_y]
-                if blocking_piece == '_':
-                    if target == '_' or piece.islower() != target.islower():
-                        moves.append((nx, ny))
-
-        return moves
-
-    def get_piece_canon_moves(self, position):
-        x, y = position
-        piece = self.board[x][y]
-        moves = []
+        return targets
 
-        directions = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+    def _cannon_targets(self, sq, piece):
+        squares = self.squares
+        targets = []
 
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
+        for ray in RAYS[sq]:
             has_cannon = False
-
-            while 0 <= nx < 10 and 0 <= ny < 9:
-                target = self.board[nx][ny]
+            for dst in ray:
+                target = squares[dst]
 
                 if not has_cannon:
-                    if target == '_':
-                        moves.append((nx, ny))
+                    if target == EMPTY:
+                        targets.append(dst)
                     else:
                         has_cannon = True
-                else:
-                    if target != '_':
-                        if piece.islower() != target.islower():
-                            moves.append((nx, ny))
-                        break
-
-                nx, ny = nx + dx, ny + dy
-
-        return moves
-
-    def get_piece_pawn_moves(self, position):
-        x, y = position
-        piece = self.board[x][y]
-        moves = []
-
-        if piece.islower():
-            directions = [(1, 0)]
-            if x >= 5:
-                directions.extend([(0, 1), (0, -1)])
-        else:
-            directions = [(-1, 0)]
-            if x <= 4:
-                directions.extend([(0, 1), (0, -1)])
-
-        for dx, dy in directions:
-            nx, ny = x + dx, y + dy
-
-            if 0 <= nx < 10 and 0 <= ny < 9:
-                target = self.board[nx][ny]
-                if target == '_' or piece.islower() != target.islower():
-                    moves.append((nx, ny))
+                elif target != EMPTY:
+                    if target * piece < 0:
+                        targets.append(dst)
+                    break
 
-        return moves
+        return targets
 
     def is_in_check(self, is_red_turn):
-        king_symbol = 'K' if is_red_turn else 'k'
-        king_position = None
+        king_sq = self._king_squares[not is_red_turn]
+        if king_sq is None:
+            return False
+        return self._is_king_attacked(king_sq, not is_red_turn)
 
-        # 寻找当前玩家的帅/将的位置
-        for x in range(10):
-            for y in range(9):
-                if self.board[x][y] == king_symbol:
-                    king_position = (x, y)
-                    break
-            if king_position is not None:
-                break
+    def _is_king_attacked(self, king_sq, is_black_king):
+        # 从将/帅的位置向外探测攻击者, 不再生成对方全部走法
+        squares = self.squares
+        sign = 1 if is_black_king else -1
+        rook, cannon, knight, pawn, king = ROOK * sign, CANNON * sign, KNIGHT * sign, PAWN * sign, KING * sign
 
-        # 遍历棋盘上所有对方棋子的可移动位置，判断是否将军
-        for x in range(10):
-            for y in range(9):
-                piece = self.board[x][y]
-                if piece != '_' and piece.islower() != king_symbol.islower():
-                    piece_moves = self.get_piece_moves((x, y))
-                    if king_position in piece_moves:
+        # 车/炮/将帅照面
+        flying_ray = RAY_DOWN if is_black_king else RAY_UP
+        for direction, ray in enumerate(RAYS[king_sq]):
+            has_cannon = False
+            for sq in ray:
+                piece = squares[sq]
+                if piece == EMPTY:
+                    continue
+                if has_cannon:
+                    if piece == cannon:
                         return True
+                    break
+                if piece == rook or (piece == king and direction == flying_ray):
+                    return True
+                has_cannon = True
+
+        # 马, 注意马腿是相对于马的位置
+        for origin, leg in KNIGHT_ATTACKS[king_sq]:
+            if squares[origin] == knight and squares[leg] == EMPTY:
+                return True
+
+        # 兵/卒
+        for origin in PAWN_ATTACKS[sign < 0][king_sq]:
+            if squares[origin] == pawn:
+                return True
+
+        # 士/象只有在将/帅飞出九宫吃掉对方将/帅之后才可能够得着
+        for origin in ADVISOR_ATTACKS[sign < 0][king_sq]:
+            if squares[origin] == ADVISOR * sign:
+                return True
+        for origin, eye in BISON_ATTACKS[sign < 0][king_sq]:
+            if squares[origin] == BISON * sign and squares[eye] == EMPTY:
+                return True
 
         return False
 
     def is_checkmate(self):
+        # 走子方无子可走即判负: 被将死, 或者没被将军但无棋可走 (困毙)
         is_red_turn = self.is_red_turn
 
-        if not self.is_in_check(is_red_turn):
+        # 将/帅已经被吃掉时由 is_game_over 判定胜负
+        if self._king_squares[not is_red_turn] is None:
             return False
 
-        for x in range(10):
-            for y in range(9):
-                piece = self.board[x][y]
-                if piece != '_' and piece.islower() == is_red_turn:
-                    piece_moves = self.get_piece_moves((x, y))
-
-                    for move in piece_moves:
-                        # 尝试走子
-                        origin_piece = self.board[move[0]][move[1]]
-                        self.board[move[0]][move[1]] = piece
-                        self.board[x][y] = '_'
-
-                        # 检查是否摆脱了将军状态
-                        is_safe = not self.is_in_check(is_red_turn)
-
-                        # 撤销走子
-                        self.board[x][y] = piece
-                        self.board[move[0]][move[1]] = origin_piece
-
-                        if is_safe:
-                            return False
+        # 同一个局面只做一次完整的证明
+        key = self.zobrist_key
+        memo_key, is_checkmate = self._checkmate_memo
+        if memo_key == key:
+            return is_checkmate
+
+        is_checkmate = self._prove_checkmate(not is_red_turn)
+        self._checkmate_memo = (key, is_checkmate)
+        return is_checkmate
+
+    def _side_to_move_in_check(self):
+        # 记住结果, 走子时一起写进局面历史, 长将判断要用
+        key = self.zobrist_key
+        memo_key, in_check = self._check_memo
+        if memo_key != key:
+            in_check = self.is_in_check(self.is_red_turn)
+            self._check_memo = (key, in_check)
+        return in_check
+
+    def _prove_checkmate(self, is_black):
+        for sq in self._pieces[is_black]:
+            for dst in self._piece_targets(sq):
+                # 尝试走子, 找到一个走完后不被将军的走法就不是死局
+                if self._is_safe_move(sq, dst, is_black):
+                    return False
 
         return True
 
@@ -424,7 +872,7 @@ class ChineseChessBoard(GameInterface):
         for x in range(10):
             row = []
             for y in range(9):
-                piece = self.board[x][y]
+                piece = PIECE_TO_CHAR[self.squares[x * 9 + y]]
                 row.append(board_symbols[piece])
             print(f"{x} {' '.join(row)}")
 
@@ -708,6 +1156,193 @@ def test_get_all_piece_position():
     a = 0;
 
 
+def test_make_unmake_move():
+    chess_board = ChineseChessBoard()
+    initial = chess_board.encode()
+
+    made = 0
+    for _ in range(40):
+        move = chess_board.random_move()
+        if move is None or chess_board.is_game_over:
+            break
+        chess_board.make_move(*move)
+        made += 1
+
+    for _ in range(made):
+        chess_board.unmake_move()
+
+    assert chess_board.encode() == initial
+    assert not chess_board.is_red_turn
+    assert chess_board.num_steps_no_capture == 0
+    assert not chess_board.is_game_over and chess_board.winner is None
+
+    # 旧的字符接口仍然可以读写
+    chess_board.board[4][4] = 'R'
+    assert chess_board.board[4][4] == 'R'
+    assert chess_board.encode()[4 * 9 + 4] == 'R'
+
+
+def test_zobrist_key():
+    chess_board = ChineseChessBoard()
+    initial_key = chess_board.zobrist_key
+
+    for _ in range(30):
+        move = chess_board.random_move()
+        if move is None or chess_board.is_game_over:
+            break
+        chess_board.move_piece(*move)
+
+        # 增量更新的键和棋子表与从头计算的结果一致
+        assert chess_board._pieces == find_pieces(chess_board.squares)
+        expected = compute_zobrist(chess_board.squares)
+        if chess_board.is_red_turn:
+            expected ^= ZOBRIST_RED_TURN_KEY
+        assert chess_board.zobrist_key == expected
+        assert chess_board.copy().zobrist_key == expected
+
+        # 不走子算出的键与走子之后的键一致
+        for src, dst in chess_board.legal_moves():
+            next_board = chess_board.copy()
+            next_board.make_move(src, dst)
+            assert chess_board.key_after_move(src, dst) == next_board.zobrist_key
+
+    while chess_board._undo_stack:
+        chess_board.unmake_move()
+    assert chess_board.zobrist_key == initial_key
+    assert chess_board._pieces == find_pieces(chess_board.squares)
+
+    # 走子方不同的相同摆法是不同的局面
+    chess_board.is_red_turn = True
+    assert chess_board.zobrist_key != initial_key
+
+    # 开局是左右对称的, 走一步之后与翻转的走法互为镜像
+    chess_board.is_red_turn = False
+    assert chess_board.mirrored_zobrist_key() == initial_key
+    chess_board.make_move((0, 1), (2, 2))
+    mirrored_board = ChineseChessBoard()
+    mirrored_board.make_move((0, 7), (2, 6))
+    assert chess_board.mirrored_zobrist_key() == mirrored_board.zobrist_key
+
+
+def test_is_in_check():
+    chess_board = ChineseChessBoard()
+    chess_board.board = [
+        ['_', '_', '_', '_', '_', '_', '_', '_', '_'] for _ in range(10)
+    ]
+    chess_board.board[0][4] = 'k'
+    chess_board.board[9][3] = 'K'
+    assert not chess_board.is_in_check(True)
+    assert not chess_board.is_in_check(False)
+
+    # 炮需要炮架
+    chess_board.board[5][3] = 'c'
+    assert not chess_board.is_in_check(True)
+    chess_board.board[7][3] = 'P'
+    assert chess_board.is_in_check(True)
+    chess_board.board[7][3] = '_'
+    chess_board.board[5][3] = '_'
+
+    # 马腿被堵住时不算将军
+    chess_board.board[7][4] = 'n'
+    assert chess_board.is_in_check(True)
+    chess_board.board[8][4] = 'A'
+    assert not chess_board.is_in_check(True)
+    chess_board.board[7][4] = '_'
+
+    # 将帅照面
+    chess_board.board[9][3] = '_'
+    chess_board.board[9][4] = 'K'
+    chess_board.board[8][4] = '_'
+    assert chess_board.is_in_check(True)
+    assert chess_board.is_in_check(False)
+
+    # 被将死: 黑车沉底, 红帅无处可走
+    chess_board.board[5][4] = 'P'
+    chess_board.board[9][0] = 'r'
+    chess_board.board[8][0] = 'r'
+    chess_board.is_red_turn = True
+    assert chess_board.is_in_check(True)
+    assert chess_board.is_checkmate()
+    assert chess_board.legal_moves() == []
+
+    # 困毙: 没被将军但无子可走, 同样判负
+    chess_board.board = [
+        ['_', '_', '_', '_', '_', '_', '_', '_', '_'] for _ in range(10)
+    ]
+    chess_board.board[0][3] = 'k'
+    chess_board.board[2][4] = 'R'
+    chess_board.board[1][2] = 'R'
+    chess_board.board[9][5] = 'K'
+    chess_board.is_red_turn = False
+    assert not chess_board.is_in_check(False)
+    assert chess_board.legal_moves() == []
+    assert chess_board.is_checkmate()
+    assert chess_board.game_over() and chess_board.winner == 'red'
+
+
+def test_legal_moves():
+    chess_board = ChineseChessBoard()
+    assert len(chess_board.legal_moves()) == 44
+
+    # 被车牵制的马不能走开, 帅也不能走到另一只车的线上
+    chess_board.board = [
+        ['_', '_', '_', '_', '_', '_', '_', '_', '_'] for _ in range(10)
+    ]
+    chess_board.board[1][4] = 'k'
+    chess_board.board[2][4] = 'r'
+    chess_board.board[0][5] = 'r'
+    chess_board.board[7][4] = 'N'
+    chess_board.board[9][4] = 'K'
+    chess_board.is_red_turn = True
+
+    moves = chess_board.legal_moves()
+    assert chess_board.get_piece_moves((7, 4))
+    assert all(src != (7, 4) for src, _ in moves)
+    assert ((9, 4), (9, 5)) not in moves
+    assert ((9, 4), (9, 3)) in moves
+
+    for src, dst in moves:
+        board = chess_board.copy()
+        board.make_move(src, dst)
+        assert not board.is_in_check(True)
+
+
+def test_repetition():
+    # 双方来回走马, 同一局面第三次出现时判和
+    chess_board = ChineseChessBoard()
+    shuffle = [((0, 1), (2, 2)), ((9, 1), (7, 2)), ((2, 2), (0, 1)), ((7, 2), (9, 1))]
+    for move in shuffle * 2:
+        assert not chess_board.game_over()
+        chess_board.make_move(*move)
+    assert chess_board.repetition_result() == 'draw'
+    assert chess_board.is_draw()
+    assert chess_board.game_over()
+    assert chess_board.get_final_reward() == 0
+
+    # 悔一步就不再重复
+    chess_board.unmake_move()
+    assert chess_board.repetition_result() is None
+
+    # 红车每一步都在将军, 长将判负
+    chess_board.board = [
+        ['_', '_', '_', '_', '_', '_', '_', '_', '_'] for _ in range(10)
+    ]
+    chess_board.board[0][3] = 'k'
+    chess_board.board[5][0] = 'R'
+    chess_board.board[9][4] = 'K'
+    chess_board.is_red_turn = True
+    chase = [((5, 0), (0, 0)), ((0, 3), (1, 3)), ((0, 0), (1, 0)), ((1, 3), (0, 3)),
+             ((1, 0), (0, 0)), ((0, 3), (1, 3)), ((0, 0), (1, 0)), ((1, 3), (0, 3)),
+             ((1, 0), (0, 0))]
+    for move in chase:
+        assert not chess_board.game_over()
+        chess_board.make_move(*move)
+    assert chess_board.repetition_result() == 'black'
+    assert not chess_board.is_draw()
+    assert chess_board.game_over()
+    assert chess_board.winner == 'black'
+
+
 if __name__ == '__main__':
     test_king_moves()
     test_advisor_moves()
@@ -720,6 +1355,11 @@ if __name__ == '__main__':
     draw()
     test_red_win_king_eat_king()
     test_get_all_piece_position()
+    test_make_unmake_move()
+    test_zobrist_key()
+    test_is_in_check()
+    test_legal_moves()
+    test_repetition()
 
     board = ChineseChessBoard()
     print(board.encode())
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 from sys import exit
 
 import pygame
@@ -9,13 +10,23 @@ from tensorflow.keras.models import load_model
 from ChineseChessBoard import ChineseChessBoard
 from log.logger import logger
 from mcstx import Mcst
+from tablebase import Tablebase
 
 
 class GameUI(object):
+    # 电脑每步最多想这么多秒, 根节点 (包括对手思考时搜索的) 最多搜索这么多次
+    THINK_TIME = 3.0
+    MAX_SEARCHES = 800
+    # 对手思考时后台最多搜索这么多次
+    PONDER_SEARCHES = 20000
+    # python tablebase.py tablebase.cctb 生成的残局库, 没有时不用
+    TABLEBASE_FILE = 'tablebase.cctb'
+
     def __init__(self):
         pygame.init()
         pygame.display.set_caption("cchess")
         self.model = load_model('model_wukong_arena_20epoch.h5')
+        self.tablebase = Tablebase(self.TABLEBASE_FILE) if os.path.exists(self.TABLEBASE_FILE) else None
         self.__screen = pygame.display.set_mode((720, 800), 0, 32)
         self.__background = pygame.image.load('images/boardchess.jpg').convert()
 
@@ -34,6 +45,8 @@ class GameUI(object):
 
     def run(self):
         board = ChineseChessBoard()
+        # 同一盘棋里一直用同一棵树, 双方每走一步都换根, 保留下来的子树接着搜索
+        mcst = None
         is_piece_picked = False
         piece_src_position = None
 
@@ -61,7 +74,8 @@ class GameUI(object):
                             logger.info("pick another chess %s, src pos is %s", str(which_piece_is_picked), str(piece_src_position))
                             break
                         else:
-                            if not board.is_valid_move(src, dst):
+                            # 走完后自己被将军的走法也不能走
+                            if (src, dst) not in board.legal_moves():
                                 is_piece_picked = False
                                 piece_src_position = None
                                 break
@@ -70,11 +84,21 @@ class GameUI(object):
                             is_piece_picked = False
                             self.refresh_board(board)
 
+                            if mcst is not None:
+                                # 停下后台搜索, 换到玩家走的这一步, 它的子树保留着后台搜索的结果
+                                mcst.stop_pondering()
+                                mcst.update_root(src, dst)
+
                             if board.is_game_over:
                                 break
 
                             # board_state, ai_move_start_pos, ai_move_end_pos = Mcts().search(board, 300)
-                            node = Mcst(self.model).start(board, 200)
+                            if mcst is None:
+                                mcst = Mcst(self.model, tablebase=self.tablebase)
+                                node = mcst.anytime_start(board.copy(), self.MAX_SEARCHES, self.THINK_TIME)
+                            else:
+                                node = mcst.anytime_search(max(self.MAX_SEARCHES - mcst.root.visits, 0),
+                                                           self.THINK_TIME)
 
                             if node is None or node.source is None or node.target is None:
                                 logger.info("mcst return invalid node: %s", str(node))
@@ -84,6 +108,9 @@ class GameUI(object):
                                 break
 
                             board.move_piece(node.source, node.target)
+                            mcst.update_root(node.source, node.target)
+                            # 玩家思考的时候接着搜索
+                            mcst.start_pondering(self.PONDER_SEARCHES)
 
                 if event.type == QUIT:
                     exit()
@@ -93,6 +120,9 @@ class GameUI(object):
                 if board.is_game_over:
                     game_over(board)
                     board = ChineseChessBoard()
+                    if mcst is not None:
+                        mcst.stop_pondering()
+                    mcst = None
                     continue
 
     def refresh_board(self, board):
@@ -1,17 +1,22 @@
+import os
+
 from tensorflow.keras.models import load_model
 
 from ChineseChessBoard import ChineseChessBoard
+from evalcache import EvaluationCache
 from log.logger import logger
 from mcstx import Mcst
+from searchstats import SearchStats
+from tablebase import Tablebase
 import datetime
 
 
-def ai_play_one_round(neural_model, search_number):
+def ai_play_one_round(neural_model, search_number, evaluation_cache=None, search_stats=None, tablebase=None):
     board = ChineseChessBoard()
     game_record = []
 
-    mcst = Mcst(neural_model)
-    node = mcst.parallel_start(board, search_number)
+    mcst = Mcst(neural_model, evaluation_cache=evaluation_cache, search_stats=search_stats, tablebase=tablebase)
+    node = mcst.anytime_start(board, search_number)
 
     print(f"red from {node.source} to {node.target}")
 
@@ -19,7 +24,9 @@ def ai_play_one_round(neural_model, search_number):
         logger.info("return error node %s", str(node))
         return None
 
-    while not node.board.is_game_over:
+    # 走进残局库里有的局面时结果已定, 不用再下完
+    adjudicated = None
+    while not node.is_terminal:
         game_record.append((node.board.copy(), (node.source, node.target)))
 
         next_board = node.board.copy()
@@ -29,7 +36,8 @@ def ai_play_one_round(neural_model, search_number):
 
         turn = "red" if node.board.is_red_turn else "black"
 
-        node = mcst.parallel_search(search_number - mcst.root.visits)
+        # 保留下来的子树已有的访问次数也算在 search_number 里, 结果已定时提前停下
+        node = mcst.anytime_search(max(search_number - mcst.root.visits, 0))
 
         if node is None or node.source is None or node.target is None:
             logger.info("return error node %s", str(node))
@@ -37,8 +45,15 @@ def ai_play_one_round(neural_model, search_number):
 
         print(f"{turn} from {node.source} to {node.target}")
 
+        if tablebase is not None:
+            adjudicated = tablebase.winner(node.board)
+            if adjudicated is not None:
+                print(f"tablebase result: {adjudicated}")
+                break
+
     # save the result of the game
-    winner = 1 if node.board.winner == 'red' else -1 if node.board.winner == 'black' else 0
+    winner = adjudicated or node.board.winner
+    winner = 1 if winner == 'red' else -1 if winner == 'black' else 0
     game_record = [(record[0], record[1], winner) for record in game_record]
 
     return game_record
@@ -52,24 +67,34 @@ def save_game_record(game_record, filename):
         f.write("-----------\n")
 
 
-def ai_play(neural_model, search_number, rounds, filename_prefix):
+def ai_play(neural_model, search_number, rounds, filename_prefix, tablebase=None):
     """Let the AI play multiple rounds of game and save the records."""
     # Create an initial filename
     timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     filename = f"{filename_prefix}_{timestamp}.txt"
 
-    for i in range(1, rounds + 1):
-        game_record = ai_play_one_round(neural_model, search_number)
-        print(f"rounds: {i + 1}/{rounds}, timestamp: ", timestamp)
+    # 开局附近的局面每盘都会重复出现, 评估缓存在各盘之间共用
+    evaluation_cache = EvaluationCache()
+
+    # 搜索各阶段的耗时等统计, 每分钟写一行 JSON
+    with open(f"{filename_prefix}_search_stats_{timestamp}.jsonl", 'a') as stats_file:
+        search_stats = SearchStats(stats_file, log_interval=60)
+
+        for i in range(1, rounds + 1):
+            game_record = ai_play_one_round(neural_model, search_number, evaluation_cache, search_stats, tablebase)
+            print(f"rounds: {i + 1}/{rounds}, timestamp: ", timestamp)
+            print(f"evaluation cache hit rate: {evaluation_cache.hit_rate:.2%} "
+                  f"({evaluation_cache.hits} hits, {evaluation_cache.misses} misses)")
 
-        # Create a new file for every 100 games
-        if i % 100 == 0:
-            timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-            filename = f"{filename_prefix}_{timestamp}.txt"
+            # Create a new file for every 100 games
+            if i % 100 == 0:
+                timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+                filename = f"{filename_prefix}_{timestamp}.txt"
 
-        save_game_record(game_record, filename)
+            save_game_record(game_record, filename)
 
 
 if __name__ == '__main__':
-    ai_play(load_model('model_wukong_arena_20epoch.h5'), 10, 1000, "records/record")
+    tablebase = Tablebase('tablebase.cctb') if os.path.exists('tablebase.cctb') else None
+    ai_play(load_model('model_wukong_arena_20epoch.h5'), 10, 1000, "records/record", tablebase)
     exit()
@@ -0,0 +1,418 @@
+import math
+import random
+
+import numpy as np
+
+from ChineseChessBoard import ChineseChessBoard, SQUARE_TO_POS
+from encoder import board_to_tensor
+from mcstx import legal_priors, uci_labels
+
+# first_child 的取值: 还没有展开, 以及展开过但无子可走
+UNEXPANDED = -1
+NO_CHILDREN = -2
+
+
+class ArrayTree:
+    """Search tree stored as parallel NumPy arrays indexed by node id.
+
+    The children of node i are the ids first_child[i] .. first_child[i] + num_children[i] - 1,
+    so PUCT for all of them is one vectorized expression over a slice.
+    """
+
+    def __init__(self, capacity=4096):
+        self.size = 0
+        self.capacity = 0
+        self.parent = np.zeros(0, dtype=np.int32)
+        self.first_child = np.zeros(0, dtype=np.int32)
+        self.num_children = np.zeros(0, dtype=np.int32)
+        # 走到这个节点的一步, 方格下标; 根节点没有时为 -1
+        self.src = np.zeros(0, dtype=np.int16)
+        self.dst = np.zeros(0, dtype=np.int16)
+        self.prior = np.zeros(0, dtype=np.float32)
+        self.visits = np.zeros(0, dtype=np.int32)
+        self.virtual_loss = np.zeros(0, dtype=np.int32)
+        self.score = np.zeros(0, dtype=np.float64)
+        # -1 未知, 0 否, 1 是
+        self.terminal = np.zeros(0, dtype=np.int8)
+        self.reserve(capacity)
+
+    def _arrays(self):
+        return ('parent', 'first_child', 'num_children', 'src', 'dst', 'prior',
+                'visits', 'virtual_loss', 'score', 'terminal')
+
+    def reserve(self, count):
+        # 空间不够时容量翻倍
+        if self.size + count <= self.capacity:
+            return
+        capacity = max(self.size + count, self.capacity * 2, 16)
+        for name in self._arrays():
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def add_root(self, src=-1, dst=-1):
+        self.size = 0
+        self.reserve(1)
+        self._init_nodes(slice(0, 1), -1, src, dst, np.nan)
+        self.size = 1
+        return 0
+
+    def add_children(self, node, src, dst, priors):
+        count = len(src)
+        self.reserve(count)
+        first = self.size
+        self._init_nodes(slice(first, first + count), node, src, dst, priors)
+        self.first_child[node] = first
+        self.num_children[node] = count
+        self.size += count
+        return first
+
+    def _init_nodes(self, ids, parent, src, dst, prior):
+        self.parent[ids] = parent
+        self.first_child[ids] = UNEXPANDED
+        self.num_children[ids] = 0
+        self.src[ids] = src
+        self.dst[ids] = dst
+        self.prior[ids] = prior
+        self.visits[ids] = 0
+        self.virtual_loss[ids] = 0
+        # 分数在第一次回传时才加上, 与 mcstx.Mcst 一致
+        self.score[ids] = 0
+        self.terminal[ids] = -1
+
+    def is_expanded(self, node):
+        return self.first_child[node] != UNEXPANDED
+
+    def set_no_children(self, node):
+        self.first_child[node] = NO_CHILDREN
+        self.num_children[node] = 0
+
+    def children(self, node):
+        first = self.first_child[node]
+        if first < 0:
+            return range(0)
+        return range(first, first + self.num_children[node])
+
+    def find_child(self, node, src, dst):
+        for child in self.children(node):
+            if self.src[child] == src and self.dst[child] == dst:
+                return child
+        return None
+
+    def select_child(self, node, is_red_turn, exploration_constant):
+        # 与 Mcst.get_best_move 相同的 PUCT, 所有子节点一次算完
+        count = self.num_children[node]
+        if count == 0:
+            return None
+        first = self.first_child[node]
+        ids = slice(first, first + count)
+
+        current_player = -1 if is_red_turn else 1
+        visits = self.visits[ids]
+        virtual_loss = self.virtual_loss[ids]
+        effective_visits = visits + virtual_loss
+        exploitation = np.where(effective_visits > 0,
+                                (current_player * self.score[ids] - virtual_loss) / np.maximum(effective_visits, 1),
+                                0)
+        exploration = exploration_constant / np.sqrt(1 + visits) * self.prior[ids] * \
+            math.sqrt(self.visits[node]) / (1 + effective_visits)
+        move_scores = exploitation + exploration
+
+        best = np.flatnonzero(move_scores == move_scores.max())
+        return first + int(best[0] if len(best) == 1 else random.choice(best))
+
+    def backpropagate(self, path, value):
+        # path 是从根到叶子的节点下标, value 是这一次模拟的价值; 叶子是根时 (没有先验概率) 不回传
+        if np.isnan(self.prior[path[-1]]):
+            return
+        path = np.array(path)
+        self.visits[path] += 1
+        # 根节点从来不加虚拟损失
+        self.virtual_loss[path[1:]] -= 1
+        self.score[path] += value
+
+    def compact(self, root):
+        """Keep only the subtree under root, renumbered breadth first so root becomes node 0."""
+        levels = [np.array([root])]
+        level = levels[0]
+        while True:
+            expanded = level[self.first_child[level] >= 0]
+            if expanded.size == 0:
+                break
+            counts = self.num_children[expanded]
+            # 每个展开节点的子节点区间拼在一起, 同一个父节点的子节点仍然连续
+            starts = np.repeat(self.first_child[expanded] - np.cumsum(counts) + counts, counts)
+            level = starts + np.arange(counts.sum())
+            levels.append(level)
+
+        old_ids = np.concatenate(levels)
+        new_ids = np.full(self.size, -1, dtype=np.int32)
+        new_ids[old_ids] = np.arange(len(old_ids), dtype=np.int32)
+
+        for name in self._arrays():
+            array = getattr(self, name)
+            array[:len(old_ids)] = array[old_ids]
+        kept = slice(0, len(old_ids))
+        self.parent[kept] = np.where(self.parent[kept] >= 0, new_ids[np.maximum(self.parent[kept], 0)], -1)
+        self.parent[0] = -1
+        self.first_child[kept] = np.where(self.first_child[kept] >= 0,
+                                          new_ids[np.maximum(self.first_child[kept], 0)], self.first_child[kept])
+        self.size = len(old_ids)
+        return 0
+
+
+class ArrayNode:
+    """The attributes of a mcstx.TreeNode that aiplay and GameUI read, for a node of an ArrayMcst."""
+
+    def __init__(self, mcst, index, board):
+        self.mcst = mcst
+        self.index = index
+        self.board = board
+
+    @property
+    def source(self):
+        src = self.mcst.tree.src[self.index]
+        return SQUARE_TO_POS[src] if src >= 0 else None
+
+    @property
+    def target(self):
+        dst = self.mcst.tree.dst[self.index]
+        return SQUARE_TO_POS[dst] if dst >= 0 else None
+
+    @property
+    def visits(self):
+        return int(self.mcst.tree.visits[self.index])
+
+    @property
+    def score(self):
+        return float(self.mcst.tree.score[self.index])
+
+    @property
+    def is_terminal(self):
+        return self.board.game_over()
+
+
+class ArrayMcst:
+    """mcstx.Mcst search on an ArrayTree.
+
+    One working board follows the selected path with make_move / unmake_move instead of every node
+    keeping its own board. Transpositions are not shared in this store.
+    """
+
+    def __init__(self, model, capacity=4096, evaluation_cache=None):
+        self.model = model
+        self.tree = ArrayTree(capacity)
+        self.root_board = None
+        self.evaluation_cache = evaluation_cache
+        # 一批的网络输入直接编码进这块缓冲区, 不为每个叶子单独分配
+        self.inputs = np.empty((0, 10, 9, 9), dtype=np.float32)
+
+    @property
+    def root(self):
+        return ArrayNode(self, 0, self.root_board)
+
+    def start(self, initial_state, num_searches):
+        return self.batch_start(initial_state, num_searches, 1)
+
+    def search(self, num_searches):
+        return self.batch_search(num_searches, 1)
+
+    def batch_start(self, initial_state, num_searches, batch_size=16):
+        print(f"start search {num_searches} times.")
+        self.root_board = initial_state
+        self.tree.add_root()
+        return self.batch_search(num_searches, batch_size)
+
+    def batch_search(self, num_searches, batch_size=16):
+        print(f"search count: {num_searches}, batch size: {batch_size}")
+
+        done = 0
+        while done < num_searches:
+            paths, pending = self.select_batch(min(batch_size, num_searches - done))
+            if not paths and not pending:
+                break
+
+            if pending:
+                policy_preds, value_preds = self.model.predict(self.inputs[:len(pending)])
+                for i, (path, _, moves, cache_key) in enumerate(pending):
+                    value = value_preds[i].item()
+                    if self.evaluation_cache is not None:
+                        self.evaluation_cache.put(cache_key, policy_preds[i], value)
+                    leaf = self.expand(path[-1], moves, policy_preds[i])
+                    if leaf is None:
+                        # 无子可走, 撤回这条路径的虚拟损失
+                        self.tree.virtual_loss[path[1:]] -= 1
+                    else:
+                        paths.append((path + [leaf], value))
+
+            for path, value in paths:
+                self.tree.backpropagate(path, value)
+            done += len(paths) + sum(1 for path, _, _, _ in pending if not self.tree.num_children[path[-1]])
+
+        return self.best_move()
+
+    def select_batch(self, batch_size):
+        """Walk down batch_size times with virtual loss on the working board.
+
+        Returns (path, value) for terminal (or cache-evaluated) nodes and, for each distinct unexpanded node,
+        (path, input tensor, legal moves, cache key) captured while the board was at that node.
+        The input tensors are rows of self.inputs.
+        """
+        tree = self.tree
+        board = self.root_board
+        paths = []
+        pending = []
+        if len(self.inputs) < batch_size:
+            self.inputs = np.empty((batch_size, 10, 9, 9), dtype=np.float32)
+        pending_nodes = set()
+
+        for _ in range(batch_size):
+            node = 0
+            path = [0]
+            while not self.is_terminal(node, board) and tree.is_expanded(node):
+                child = tree.select_child(node, board.is_red_turn, 2)
+                if child is None:
+                    break
+                tree.virtual_loss[child] += 1
+                board._make_move(int(tree.src[child]), int(tree.dst[child]))
+                path.append(child)
+                node = child
+
+            if tree.is_expanded(node) and not self.is_terminal(node, board) or node in pending_nodes:
+                # 没有可走的子节点, 或者撞上了这一批里已经要评估的节点, 撤回这条路径的虚拟损失
+                tree.virtual_loss[path[1:]] -= 1
+            elif self.is_terminal(node, board):
+                reward = board.get_final_reward()
+                paths.append((path, reward if reward is not None else 0))
+            else:
+                cache_key = evaluation = None
+                if self.evaluation_cache is not None:
+                    cache_key = self.evaluation_cache.key(board, self.last_step(path))
+                    evaluation = self.evaluation_cache.get(cache_key)
+                if evaluation is not None:
+                    # 缓存里已有评估, 直接展开, 不用等这一批的 predict
+                    policy_pred, value = evaluation
+                    leaf = self.expand(node, board.legal_move_codes(), policy_pred)
+                    if leaf is None:
+                        tree.virtual_loss[path[1:]] -= 1
+                    else:
+                        paths.append((path + [leaf], value))
+                else:
+                    pending_nodes.add(node)
+                    tensor = self.to_tensor(path, out=self.inputs[len(pending)])
+                    pending.append((path, tensor, board.legal_move_codes(), cache_key))
+
+            for _ in path[1:]:
+                board.unmake_move()
+        return paths, pending
+
+    def is_terminal(self, node, board):
+        terminal = self.tree.terminal[node]
+        if terminal < 0:
+            terminal = self.tree.terminal[node] = board.game_over()
+        return bool(terminal)
+
+    def last_step(self, path):
+        # 与 mcstx.last_step 一样, 最后一步平面用的是父节点的走法
+        tree = self.tree
+        if len(path) < 2 or tree.src[path[-2]] < 0:
+            return None
+        parent = path[-2]
+        return SQUARE_TO_POS[tree.src[parent]], SQUARE_TO_POS[tree.dst[parent]]
+
+    def to_tensor(self, path, out=None):
+        return board_to_tensor(self.root_board, self.last_step(path), out)
+
+    def expand(self, node, moves, policy_pred):
+        tree = self.tree
+        if not moves:
+            tree.set_no_children(node)
+            return None
+        moves = np.asarray(moves, dtype=np.intp)
+        src = (moves // 90).astype(np.int16)
+        dst = (moves % 90).astype(np.int16)
+        priors = legal_priors(policy_pred, moves)
+        first = tree.add_children(node, src, dst, priors)
+
+        # Select the child with the highest prior probability, as mcstx.Mcst.add_children
+        best_child = first + int(np.argmax(priors))
+        tree.virtual_loss[best_child] += 1
+        return best_child
+
+    def best_move(self):
+        child = self.tree.select_child(0, self.root_board.is_red_turn, 0)
+        if child is None:
+            return None
+        board = self.root_board.copy()
+        board._make_move(int(self.tree.src[child]), int(self.tree.dst[child]))
+        return ArrayNode(self, child, board)
+
+    def update_root(self, source, target):
+        src, dst = source[0] * 9 + source[1], target[0] * 9 + target[1]
+        board = self.root_board.copy()
+        board._make_move(src, dst)
+        self.root_board = board
+
+        child = self.tree.find_child(0, src, dst)
+        if child is None:
+            self.tree.add_root(src, dst)
+        else:
+            self.tree.compact(child)
+
+
+def test_array_tree():
+    import mcstx
+
+    class SinModel:
+        # 输出只取决于输入, 两种树拿到的评估相同
+        def predict(self, state_tensors):
+            sums = np.abs(state_tensors).reshape(len(state_tensors), -1).sum(axis=1, keepdims=True)
+            policy = np.sin(np.arange(len(uci_labels))[None, :] * 0.37 + sums).astype(np.float32)
+            return policy, np.tanh(np.cos(sums * 0.11)).astype(np.float32)
+
+    # 同样的模型和批大小, 两种树的根节点子节点访问次数一致
+    mcst = mcstx.Mcst(SinModel(), 0)
+    array_mcst = ArrayMcst(SinModel(), 16)
+    node = mcst.batch_start(ChineseChessBoard(), 300, 8)
+    array_node = array_mcst.batch_start(ChineseChessBoard(), 300, 8)
+    assert (node.source, node.target) == (array_node.source, array_node.target)
+    expected = sorted((child.source, child.target, child.visits) for child in mcst.root.children if child.visits)
+    tree = array_mcst.tree
+    actual = sorted((SQUARE_TO_POS[tree.src[c]], SQUARE_TO_POS[tree.dst[c]], int(tree.visits[c]))
+                    for c in tree.children(0) if tree.visits[c])
+    assert expected == actual
+    assert (tree.virtual_loss[:tree.size] == 0).all()
+
+    # 换根之后只留下子树, 统计不变
+    visits = array_node.visits
+    array_mcst.update_root(array_node.source, array_node.target)
+    assert array_mcst.root.visits == visits
+    assert tree.size == 1 + sum(tree.num_children[:tree.size])
+    array_mcst.batch_search(100, 8)
+    assert array_mcst.root.visits >= visits + 100
+
+
+def test_compact_no_children():
+    # 无子可走的叶子展开后不指向任何节点, 换根之后也一样
+    array_mcst = ArrayMcst(None)
+    tree = array_mcst.tree
+    tree.add_root()
+    first = tree.add_children(0, np.array([1, 2]), np.array([10, 11]), np.array([0.5, 0.5]))
+    policy_pred = np.zeros(len(uci_labels), dtype=np.float32)
+    assert array_mcst.expand(first, [], policy_pred) is None
+    array_mcst.expand(first + 1, ChineseChessBoard().legal_move_codes()[:3], policy_pred)
+
+    tree.compact(0)
+    assert tree.size == 6
+    assert tree.is_expanded(1) and list(tree.children(1)) == []
+    assert len(tree.children(2)) == 3 and all(tree.parent[child] == 2 for child in tree.children(2))
+
+    tree.compact(1)
+    assert tree.size == 1 and tree.is_expanded(0) and list(tree.children(0)) == []
+
+
+if __name__ == '__main__':
+    test_array_tree()
+    test_compact_no_children()
@@ -0,0 +1,341 @@
+import numpy as np
+
+from ChineseChessBoard import (ChineseChessBoard, EMPTY, ROOK, KNIGHT, BISON, ADVISOR, KING, CANNON, PAWN,
+                               PIECE_TO_CHAR, SQUARE_TO_POS, RAYS, RAY_UP, RAY_DOWN, KING_MOVES, ADVISOR_MOVES,
+                               BISON_MOVES, PAWN_MOVES, KNIGHT_MOVES, KNIGHT_ATTACKS, BISON_ATTACKS,
+                               ADVISOR_ATTACKS, PAWN_ATTACKS)
+from mcstx import uci_labels, to_uci_label
+
+NUM_LABELS = len(uci_labels)
+
+# 补在每个局面末尾的哑方格, 永远为空, 用来把长短不一的表补齐成矩阵
+PAD = 90
+
+
+def _label_to_squares(label):
+    # 与 mcstx.to_uci_label 相反: 字母是列, 数字是 9 - 行
+    src = (9 - int(label[1])) * 9 + ord(label[0]) - ord('a')
+    dst = (9 - int(label[3])) * 9 + ord(label[2]) - ord('a')
+    return src, dst
+
+
+def _padded(rows, width, fill=PAD):
+    table = np.full((len(rows), width), fill, dtype=np.intp)
+    for i, row in enumerate(rows):
+        table[i, :len(row)] = row
+    return table
+
+
+def _build_label_tables():
+    # 直线走法中间有几个子 = 前缀和[hi] - 前缀和[lo], 见 _occupancy_prefix
+    size = NUM_LABELS
+    label_src = np.zeros(size, dtype=np.intp)
+    label_dst = np.zeros(size, dtype=np.intp)
+    between_hi = np.full(size, PREFIX_ZERO, dtype=np.intp)
+    between_lo = np.full(size, PREFIX_ZERO, dtype=np.intp)
+    # 马腿/象眼
+    leg = np.full(size, PAD, dtype=np.intp)
+    # 每种棋子、每方、每个方格能走的 label, 第二维 0 为红方, 1 为黑方
+    piece_labels = {piece: [[[] for _ in range(90)] for _ in (0, 1)]
+                    for piece in (ROOK, KNIGHT, BISON, ADVISOR, KING, CANNON, PAWN)}
+    king_step = np.zeros((2, size), dtype=bool)
+
+    for index, label in enumerate(uci_labels):
+        src, dst = _label_to_squares(label)
+        label_src[index] = src
+        label_dst[index] = dst
+        (src_x, src_y), (dst_x, dst_y) = SQUARE_TO_POS[src], SQUARE_TO_POS[dst]
+
+        for direction, ray in enumerate(RAYS[src]):
+            if dst not in ray:
+                continue
+            if src_x == dst_x:
+                between_hi[index] = src_x * 10 + max(src_y, dst_y)
+                between_lo[index] = src_x * 10 + min(src_y, dst_y) + 1
+            else:
+                between_hi[index] = 100 + max(src_x, dst_x) * 9 + src_y
+                between_lo[index] = 100 + (min(src_x, dst_x) + 1) * 9 + src_y
+            for is_black in (0, 1):
+                piece_labels[ROOK][is_black][src].append(index)
+                piece_labels[CANNON][is_black][src].append(index)
+                # 将帅照面: 红帅向上, 黑将向下
+                if direction == (RAY_DOWN if is_black else RAY_UP) and dst not in KING_MOVES[is_black][src]:
+                    piece_labels[KING][is_black][src].append(index)
+
+        for target, knight_leg in KNIGHT_MOVES[src]:
+            if target == dst:
+                leg[index] = knight_leg
+                for is_black in (0, 1):
+                    piece_labels[KNIGHT][is_black][src].append(index)
+
+        for is_black in (0, 1):
+            if dst in KING_MOVES[is_black][src]:
+                king_step[is_black, index] = True
+                piece_labels[KING][is_black][src].append(index)
+            if dst in ADVISOR_MOVES[is_black][src]:
+                piece_labels[ADVISOR][is_black][src].append(index)
+            if dst in PAWN_MOVES[is_black][src]:
+                piece_labels[PAWN][is_black][src].append(index)
+            for target, eye in BISON_MOVES[is_black][src]:
+                if target == dst:
+                    leg[index] = eye
+                    piece_labels[BISON][is_black][src].append(index)
+
+    # 补齐用的 label 指向 NUM_LABELS, 查表前先在末尾补一个永远不合法的哑走法
+    tables = {}
+    for piece, by_side in piece_labels.items():
+        width = max(len(labels) for side in by_side for labels in side)
+        tables[piece] = np.stack([_padded(side, width, NUM_LABELS) for side in by_side])
+
+    def extend(table, fill):
+        return np.concatenate([table, np.full(table.shape[:-1] + (1,), fill, dtype=table.dtype)], axis=-1)
+
+    return (extend(label_src, PAD), extend(label_dst, PAD), extend(between_hi, PREFIX_ZERO),
+            extend(between_lo, PREFIX_ZERO), extend(leg, PAD), extend(king_step, False), tables)
+
+
+def _occupancy_prefix(squares):
+    # 每行、每列占用数的前缀和拼成一个 (N, 200) 数组, 最后一列恒为 0
+    num = squares.shape[0]
+    occupied = (squares != EMPTY).reshape(num, 10, 9).astype(np.int8)
+    prefix = np.zeros((num, 200), dtype=np.int8)
+    prefix[:, :100].reshape(num, 10, 10)[:, :, 1:] = np.cumsum(occupied, axis=2)
+    prefix[:, 100:199].reshape(num, 11, 9)[:, 1:, :] = np.cumsum(occupied, axis=1)
+    return prefix
+
+
+PREFIX_ZERO = 199
+
+(LABEL_SRC, LABEL_DST, LABEL_BETWEEN_HI, LABEL_BETWEEN_LO, LABEL_LEG, LABEL_KING_STEP,
+ PIECE_LABELS) = _build_label_tables()
+
+# 将/帅受攻击判断用的补齐表
+RAY_TABLE = np.array([[ray + [PAD] * (9 - len(ray)) for ray in RAYS[sq]] for sq in range(90)], dtype=np.intp)
+KNIGHT_ATTACK_ORIGIN = _padded([[origin for origin, _ in KNIGHT_ATTACKS[sq]] for sq in range(90)], 8)
+KNIGHT_ATTACK_LEG = _padded([[leg for _, leg in KNIGHT_ATTACKS[sq]] for sq in range(90)], 8)
+BISON_ATTACK_ORIGIN = np.stack([_padded([[o for o, _ in BISON_ATTACKS[c][sq]] for sq in range(90)], 4) for c in (0, 1)])
+BISON_ATTACK_EYE = np.stack([_padded([[e for _, e in BISON_ATTACKS[c][sq]] for sq in range(90)], 4) for c in (0, 1)])
+ADVISOR_ATTACK_ORIGIN = np.stack([_padded(ADVISOR_ATTACKS[c], 4) for c in (0, 1)])
+PAWN_ATTACK_ORIGIN = np.stack([_padded(PAWN_ATTACKS[c], 3) for c in (0, 1)])
+
+
+def kings_attacked(squares, own_sign):
+    """For each flat (M, 90) position, whether the king of own_sign (+1 red, -1 black) is attacked."""
+    num = squares.shape[0]
+    rows = np.arange(num)
+    flat = np.concatenate([squares, np.zeros((num, 1), dtype=squares.dtype)], axis=1).ravel()
+    offset = (rows * 91)[:, None]
+    enemy = -own_sign.astype(np.int8)
+
+    own_king = squares == (KING * own_sign)[:, None]
+    has_king = own_king.any(axis=1)
+    king_sq = own_king.argmax(axis=1)
+
+    # 车/炮/将帅照面: 每条射线上的第一个和第二个棋子
+    ray_pieces = flat[offset[:, :, None] + RAY_TABLE[king_sq]]
+    occupied = ray_pieces != EMPTY
+    first_index = occupied.argmax(axis=2)
+    first_piece = np.take_along_axis(ray_pieces, first_index[..., None], axis=2)[..., 0]
+    # 第一个子及其之前的格子都去掉, 再找一次就是第二个子; 射线上没有子时取到的是空格
+    occupied &= np.arange(9) > first_index[..., None]
+    second_piece = np.take_along_axis(ray_pieces, occupied.argmax(axis=2)[..., None], axis=2)[..., 0]
+    second_piece = np.where(occupied.any(axis=2), second_piece, EMPTY)
+
+    flying_ray = np.where(own_sign > 0, RAY_UP, RAY_DOWN)
+    attacked = (first_piece == (ROOK * enemy)[:, None]).any(axis=1)
+    attacked |= first_piece[rows, flying_ray] == KING * enemy
+    attacked |= (second_piece == (CANNON * enemy)[:, None]).any(axis=1)
+
+    # 马
+    knight = (flat[offset + KNIGHT_ATTACK_ORIGIN[king_sq]] == (KNIGHT * enemy)[:, None]) & \
+             (flat[offset + KNIGHT_ATTACK_LEG[king_sq]] == EMPTY)
+    attacked |= knight.any(axis=1)
+
+    # 兵/卒、士、象, 按攻击方的颜色查表
+    attacker = (enemy < 0).astype(np.intp)
+    attacked |= (flat[offset + PAWN_ATTACK_ORIGIN[attacker, king_sq]] == (PAWN * enemy)[:, None]).any(axis=1)
+    attacked |= (flat[offset + ADVISOR_ATTACK_ORIGIN[attacker, king_sq]] == (ADVISOR * enemy)[:, None]).any(axis=1)
+    bison = (flat[offset + BISON_ATTACK_ORIGIN[attacker, king_sq]] == (BISON * enemy)[:, None]) & \
+            (flat[offset + BISON_ATTACK_EYE[attacker, king_sq]] == EMPTY)
+    attacked |= bison.any(axis=1)
+
+    return attacked & has_king
+
+
+class BatchBoard:
+    """N positions in one (N, 10, 9) int8 array, with move masks over the uci_labels action space."""
+
+    def __init__(self, boards, is_red_turn, num_steps_no_capture=None):
+        self.boards = np.ascontiguousarray(boards, dtype=np.int8)
+        self.is_red_turn = np.asarray(is_red_turn, dtype=bool).copy()
+        num = self.boards.shape[0]
+        if num_steps_no_capture is None:
+            num_steps_no_capture = np.zeros(num, dtype=np.int32)
+        self.num_steps_no_capture = np.asarray(num_steps_no_capture, dtype=np.int32).copy()
+        self.is_game_over = np.zeros(num, dtype=bool)
+
+    @staticmethod
+    def from_boards(boards):
+        return BatchBoard(np.array([board.squares for board in boards], dtype=np.int8).reshape(-1, 10, 9),
+                          [board.is_red_turn for board in boards],
+                          [board.num_steps_no_capture for board in boards])
+
+    def __len__(self):
+        return self.boards.shape[0]
+
+    @property
+    def squares(self):
+        # (N, 90) 视图, 与 ChineseChessBoard.squares 的下标一致
+        return self.boards.reshape(-1, 90)
+
+    def get_board(self, index):
+        encoded = "".join(PIECE_TO_CHAR[piece] for piece in self.squares[index].tolist())
+        board = ChineseChessBoard.decode(encoded, bool(self.is_red_turn[index]))
+        board.num_steps_no_capture = int(self.num_steps_no_capture[index])
+        return board
+
+    def pseudo_legal_mask(self):
+        board_index, label_index = self._pseudo_legal_moves()
+        mask = np.zeros((len(self), NUM_LABELS), dtype=bool)
+        mask[board_index, label_index] = True
+        return mask
+
+    def _pseudo_legal_moves(self):
+        # 按棋子种类分组, 每组只看这种棋子在该格可能走的 label; 返回 (局面下标, label) 两个数组
+        num = len(self)
+        squares = self.squares
+        flat = np.concatenate([squares, np.zeros((num, 1), dtype=np.int8)], axis=1).ravel()
+        sign = np.where(self.is_red_turn, 1, -1).astype(np.int8)
+        owned = squares * sign[:, None]
+        prefix = _occupancy_prefix(squares).ravel()
+
+        moves_board, moves_label = [], []
+        for piece, table in PIECE_LABELS.items():
+            board_index, src = np.nonzero(owned == piece)
+            if board_index.size == 0:
+                continue
+            labels = table[(~self.is_red_turn[board_index]).astype(np.intp), src]
+            board_offset = (board_index * 91)[:, None]
+            dst_piece = flat[board_offset + LABEL_DST[labels]] * sign[board_index][:, None]
+
+            if piece in (ROOK, CANNON, KING):
+                prefix_offset = (board_index * 200)[:, None]
+                between = prefix[prefix_offset + LABEL_BETWEEN_HI[labels]] - \
+                    prefix[prefix_offset + LABEL_BETWEEN_LO[labels]]
+            if piece == ROOK:
+                ok = (between == 0) & (dst_piece <= 0)
+            elif piece == CANNON:
+                # 炮隔一子只能吃对方的棋子
+                ok = ((between == 0) & (dst_piece == EMPTY)) | ((between == 1) & (dst_piece < 0))
+            elif piece == KING:
+                ok = np.where(LABEL_KING_STEP[(~self.is_red_turn[board_index]).astype(np.intp)[:, None], labels],
+                              dst_piece <= 0, (between == 0) & (dst_piece == -KING))
+            elif piece in (KNIGHT, BISON):
+                ok = (flat[board_offset + LABEL_LEG[labels]] == EMPTY) & (dst_piece <= 0)
+            else:
+                ok = dst_piece <= 0
+            # 补齐的哑走法落在永远为空的 PAD 格上, 要去掉
+            ok &= labels != NUM_LABELS
+
+            pair, slot = np.nonzero(ok)
+            moves_board.append(board_index[pair])
+            moves_label.append(labels[pair, slot])
+
+        if not moves_board:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        return np.concatenate(moves_board), np.concatenate(moves_label)
+
+    def legal_mask(self):
+        board_index, label_index = self._pseudo_legal_moves()
+        mask = np.zeros((len(self), NUM_LABELS), dtype=bool)
+        if board_index.size == 0:
+            return mask
+        mask[board_index, label_index] = True
+
+        squares = self.squares
+        sign = np.where(self.is_red_turn, 1, -1).astype(np.int8)
+        in_check = kings_attacked(squares, sign)
+        king_sq = (squares == (KING * sign)[:, None]).argmax(axis=1)
+
+        # 与 ChineseChessBoard._legal_square_moves 一样, 只有可能暴露将/帅的走法才需要检验:
+        # 被将军、走将/帅、离开斜邻格 (马腿/象眼), 以及将/帅所在行列上有对方车/炮/将时
+        # 离开这条线或落到线上的空位
+        square_x, square_y = np.arange(90) // 9, np.arange(90) % 9
+        on_king_line = (square_x == (king_sq // 9)[:, None]) | (square_y == (king_sq % 9)[:, None])
+        enemy = -squares * sign[:, None]
+        line_threat = (on_king_line & ((enemy == ROOK) | (enemy == CANNON) | (enemy == KING))).any(axis=1)
+
+        src, dst = LABEL_SRC[label_index], LABEL_DST[label_index]
+        king = king_sq[board_index]
+        king_x, king_y = king // 9, king % 9
+        src_x, src_y, dst_x, dst_y = src // 9, src % 9, dst // 9, dst % 9
+        need_check = in_check[board_index] | (src == king)
+        need_check |= (np.abs(src_x - king_x) == 1) & (np.abs(src_y - king_y) == 1)
+        need_check |= line_threat[board_index] & (
+            (src_x == king_x) | (src_y == king_y) |
+            (((dst_x == king_x) | (dst_y == king_y)) & (squares[board_index, dst] == EMPTY)))
+
+        board_index, label_index, src, dst = (board_index[need_check], label_index[need_check],
+                                              src[need_check], dst[need_check])
+        candidates = squares[board_index]
+        rows = np.arange(board_index.size)
+        candidates[rows, dst] = candidates[rows, src]
+        candidates[rows, src] = EMPTY
+
+        # 一次判断所有候选局面里己方将/帅是否被攻击
+        unsafe = kings_attacked(candidates, sign[board_index])
+        mask[board_index[unsafe], label_index[unsafe]] = False
+        return mask
+
+    def apply(self, actions):
+        """Play one uci_labels action per position; a negative action leaves that position unchanged."""
+        actions = np.asarray(actions)
+        active = (actions >= 0) & ~self.is_game_over
+        rows = np.nonzero(active)[0]
+        squares = self.squares
+        src, dst = LABEL_SRC[actions[rows]], LABEL_DST[actions[rows]]
+
+        captured = squares[rows, dst].copy()
+        squares[rows, dst] = squares[rows, src]
+        squares[rows, src] = EMPTY
+
+        self.num_steps_no_capture[rows] = np.where(captured != EMPTY, 0, self.num_steps_no_capture[rows] + 1)
+        self.is_game_over[rows] |= np.abs(captured) == KING
+        self.is_red_turn[rows] = ~self.is_red_turn[rows]
+
+
+def test_batch_legal_mask():
+    # 随机对局里的局面, 掩码与 ChineseChessBoard.legal_moves 逐一对照
+    label_index = {label: i for i, label in enumerate(uci_labels)}
+    boards = []
+    for _ in range(4):
+        board = ChineseChessBoard()
+        while len(boards) < 400 and not board.is_game_over:
+            boards.append(board.copy())
+            move = board.random_move()
+            if move is None:
+                break
+            board.move_piece(*move)
+
+    batch = BatchBoard.from_boards(boards)
+    mask = batch.legal_mask()
+    for i, board in enumerate(boards):
+        expected = np.zeros(NUM_LABELS, dtype=bool)
+        for src, dst in board.legal_moves():
+            expected[label_index[to_uci_label(src, dst)]] = True
+        assert (mask[i] == expected).all(), board.encode()
+
+    # 每个局面走一步之后与逐个走子的结果一致
+    actions = np.array([np.flatnonzero(row)[0] if row.any() else -1 for row in mask])
+    batch.apply(actions)
+    for i, board in enumerate(boards):
+        if actions[i] < 0:
+            continue
+        src, dst = _label_to_squares(uci_labels[actions[i]])
+        board.make_move(SQUARE_TO_POS[src], SQUARE_TO_POS[dst])
+        assert batch.get_board(i).encode() == board.encode()
+        assert bool(batch.is_red_turn[i]) == board.is_red_turn
+
+
+if __name__ == '__main__':
+    test_batch_legal_mask()
@@ -0,0 +1,104 @@
+import numpy as np
+
+from ChineseChessBoard import ChineseChessBoard, CHAR_TO_PIECE, PIECE_TO_CHAR
+
+# 网络输入 (10, 9, 9): 前 7 个平面是棋子 (红 +1, 黑 -1), 第 8 个是最后一步 (起点 -1, 终点 +1), 第 9 个是走子方
+NUM_PLANES = 9
+LAST_STEP_PLANE = 7
+TURN_PLANE = 8
+
+# 棋子编码 + 7 -> 7 个棋子平面上的取值
+PIECE_PLANES = np.zeros((15, 7), dtype=np.float32)
+for _piece in PIECE_TO_CHAR:
+    if _piece:
+        PIECE_PLANES[_piece + 7, abs(_piece) - 1] = 1 if _piece > 0 else -1
+
+# 棋谱里的字符 -> 棋子编码 + 7
+CHAR_TO_INDEX = np.full(256, 7, dtype=np.intp)
+for _char, _piece in CHAR_TO_PIECE.items():
+    CHAR_TO_INDEX[ord(_char)] = _piece + 7
+
+
+def _new_tensor(shape, out):
+    if out is None:
+        return np.empty(shape, dtype=np.float32)
+    assert out.shape == shape and out.dtype == np.float32
+    return out
+
+
+def _set_last_step(tensor, last_step):
+    tensor[:, :, LAST_STEP_PLANE] = 0
+    if last_step is not None:
+        source, target = last_step
+        # 棋谱里没有上一步时记为 (-1, -1)
+        if source is not None and target is not None and min(*source, *target) >= 0:
+            tensor[source[0], source[1], LAST_STEP_PLANE] = -1
+            tensor[target[0], target[1], LAST_STEP_PLANE] = 1
+
+
+def _fill(tensor, piece_indices, last_step, turn):
+    tensor[:, :, :7] = PIECE_PLANES[piece_indices].reshape(10, 9, 7)
+    _set_last_step(tensor, last_step)
+    tensor[:, :, TURN_PLANE] = turn
+    return tensor
+
+
+def board_to_tensor(brd: ChineseChessBoard, last_step, out=None):
+    """Network input of one board; last_step is ((x, y), (x, y)) or None. Writes into out if given."""
+    tensor = _new_tensor((10, 9, NUM_PLANES), out)
+    return _fill(tensor, np.add(brd.squares, 7), last_step, 1 if brd.is_red_turn else 0)
+
+
+def boards_to_tensor(boards, last_steps, out=None):
+    """Network input of a batch of boards, shape (N, 10, 9, 9)."""
+    tensor = _new_tensor((len(boards), 10, 9, NUM_PLANES), out)
+    if not len(boards):
+        return tensor
+    piece_indices = np.add([brd.squares for brd in boards], 7)
+    tensor[..., :7] = PIECE_PLANES[piece_indices].reshape(len(boards), 10, 9, 7)
+    for i, last_step in enumerate(last_steps):
+        _set_last_step(tensor[i], last_step)
+    tensor[..., TURN_PLANE] = np.array([1 if brd.is_red_turn else 0 for brd in boards],
+                                       dtype=np.float32)[:, None, None]
+    return tensor
+
+
+def record_to_tensor(board_state, last_step, turn, out=None):
+    """Network input of a board written as ChineseChessBoard.encode() characters, as in the game records."""
+    tensor = _new_tensor((10, 9, NUM_PLANES), out)
+    piece_indices = CHAR_TO_INDEX[np.frombuffer(board_state.encode('ascii'), dtype=np.uint8)]
+    return _fill(tensor, piece_indices, last_step, turn)
+
+
+def test_encoder():
+    board = ChineseChessBoard()
+    boards = [board.copy()]
+    steps = [None]
+    for _ in range(6):
+        move = board.random_move()
+        board.move_piece(*move)
+        boards.append(board.copy())
+        steps.append(move)
+
+    batch = boards_to_tensor(boards, steps)
+    assert batch.shape == (7, 10, 9, 9) and batch.dtype == np.float32
+    for brd, step, tensor in zip(boards, steps, batch):
+        # 逐格检查棋子平面
+        expected = np.zeros((10, 9, 7), dtype=np.float32)
+        for sq, piece in enumerate(brd.squares):
+            if piece:
+                expected[sq // 9, sq % 9, abs(piece) - 1] = 1 if piece > 0 else -1
+        assert (tensor[:, :, :7] == expected).all()
+        assert (tensor[:, :, TURN_PLANE] == (1 if brd.is_red_turn else 0)).all()
+        assert np.abs(tensor[:, :, LAST_STEP_PLANE]).sum() == (0 if step is None else 2)
+
+        # 单个局面、棋谱字符串和批量的结果一致, 写进预先分配的缓冲区也一样
+        assert (board_to_tensor(brd, step) == tensor).all()
+        turn = 1 if brd.is_red_turn else 0
+        assert (record_to_tensor(brd.encode(), step or ((-1, -1), (-1, -1)), turn) == tensor).all()
+        buffer = np.full((10, 9, 9), 5, dtype=np.float32)
+        assert board_to_tensor(brd, step, out=buffer) is buffer and (buffer == tensor).all()
+
+
+if __name__ == '__main__':
+    test_encoder()
@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ChineseChessBoard import ChineseChessBoard
+from mcstx import uci_labels
+
+
+def _build_mirror_labels():
+    # MIRROR_LABEL[i] 是第 i 个走法左右翻转之后的下标, policy[MIRROR_LABEL] 就是翻转局面的策略
+    index_by_label = {label: index for index, label in enumerate(uci_labels)}
+    mirror = np.zeros(len(uci_labels), dtype=np.intp)
+    for index, label in enumerate(uci_labels):
+        mirrored = ''.join(chr(ord('a') + ord('i') - ord(ch)) if ch.isalpha() else ch for ch in label)
+        mirror[index] = index_by_label[mirrored]
+    return mirror
+
+
+MIRROR_LABEL = _build_mirror_labels()
+
+
+def mirror_position(position):
+    return position[0], 8 - position[1]
+
+
+class EvaluationCache:
+    """LRU cache of network outputs keyed by (zobrist_key, last move), the inputs of encoder.board_to_tensor.
+
+    With mirror=True a position and its left-right mirror image share one entry, which assumes the
+    network treats the two alike.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, mirror=False):
+        self.mirror = mirror
+        # 每一项是一份 float32 策略加上键和字典的开销
+        self.entry_bytes = len(uci_labels) * 4 + 256
+        self.max_entries = max(1, max_bytes // self.entry_bytes)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def key(self, board: ChineseChessBoard, last_step):
+        """(cache key, is_mirrored) for a board and the last move plane it is encoded with."""
+        key = (board.zobrist_key, last_step)
+        if not self.mirror:
+            return key, False
+
+        mirrored_key = board.mirrored_zobrist_key()
+        mirrored_step = None
+        if last_step is not None and last_step[0] is not None:
+            mirrored_step = (mirror_position(last_step[0]), mirror_position(last_step[1]))
+
+        # 两个方向里取较小的那个作为键, 对称局面两边一样
+        mirrored = (mirrored_key, mirrored_step or ()) < (key[0], last_step or ())
+        if mirrored:
+            return (mirrored_key, mirrored_step), True
+        return key, False
+
+    def get(self, cache_key):
+        key, mirrored = cache_key
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        policy_pred, value = entry
+        if mirrored:
+            policy_pred = policy_pred[MIRROR_LABEL]
+        return policy_pred, value
+
+    def put(self, cache_key, policy_pred, value):
+        key, mirrored = cache_key
+        policy_pred = np.asarray(policy_pred, dtype=np.float32)
+        # 存的总是键所对应方向的策略
+        policy_pred = policy_pred[MIRROR_LABEL] if mirrored else policy_pred.copy()
+        with self._lock:
+            self._entries[key] = (policy_pred, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def test_evaluation_cache():
+    assert (MIRROR_LABEL[MIRROR_LABEL] == np.arange(len(uci_labels))).all()
+    assert uci_labels[MIRROR_LABEL[uci_labels.index('b0c2')]] == 'h0g2'
+
+    board = ChineseChessBoard()
+    board.make_move((9, 1), (7, 2))
+    mirrored_board = ChineseChessBoard()
+    mirrored_board.make_move((9, 7), (7, 6))
+
+    policy_pred = np.arange(len(uci_labels), dtype=np.float32)
+    cache = EvaluationCache(mirror=True)
+    cache.put(cache.key(board, ((9, 1), (7, 2))), policy_pred, 0.5)
+
+    # 翻转的局面命中同一项, 拿到的是翻转之后的策略
+    result = cache.get(cache.key(mirrored_board, ((9, 7), (7, 6))))
+    assert result is not None and result[1] == 0.5
+    assert (result[0] == policy_pred[MIRROR_LABEL]).all()
+    assert (cache.get(cache.key(board, ((9, 1), (7, 2))))[0] == policy_pred).all()
+    # 最后一步不同就是不同的输入
+    assert cache.get(cache.key(board, None)) is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # 超出容量时丢掉最久没用的
+    cache = EvaluationCache(max_bytes=2 * (len(uci_labels) * 4 + 256))
+    for step in (None, ((9, 1), (7, 2)), ((0, 1), (2, 2))):
+        cache.put(cache.key(board, step), policy_pred, 0.0)
+    assert len(cache) == 2 and cache.get(cache.key(board, None)) is None
+
+
+if __name__ == '__main__':
+    test_evaluation_cache()
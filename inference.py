@@ -0,0 +1,160 @@
+import multiprocessing
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class InferenceClient:
+    """Sends predict requests to an InferenceServer; has the same predict() as the Keras model."""
+
+    def __init__(self, requests, responses, client_id):
+        self.requests = requests
+        self.responses = responses
+        self.client_id = client_id
+
+    def predict(self, inputs):
+        self.requests.put((self.client_id, np.asarray(inputs, dtype=np.float32)))
+        result = self.responses.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class InferenceServer:
+    """Owns the model and answers predict requests from search threads and worker processes in batches.
+
+    Requests that arrive within max_wait seconds of each other are stacked into one model.predict call
+    of at most max_batch_size rows (a single larger request is still answered in one call).
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait=0.002):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # 所有客户端共用一个请求队列, 每个客户端有自己的结果队列
+        self.requests = multiprocessing.Queue()
+        self._responses = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # 统计
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_rows = 0
+
+    def client(self, for_process=False):
+        # 给子进程用的客户端要在启动子进程之前创建, 作为 Process 的参数传过去
+        with self._lock:
+            client_id = len(self._responses)
+            responses = multiprocessing.Queue() if for_process else queue.Queue()
+            self._responses[client_id] = responses
+        return InferenceClient(self.requests, responses, client_id)
+
+    def predict(self, inputs):
+        # 同一进程里的搜索线程直接把服务器当作模型用, 每个线程一个客户端
+        local_client = getattr(self._local, 'client', None)
+        if local_client is None:
+            local_client = self._local.client = self.client()
+        return local_client.predict(inputs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.requests.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def serve(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            batch = [request]
+            rows = len(request[1])
+            stopping = False
+
+            # 在 max_wait 内尽量多收一些请求, 凑满 max_batch_size 就不再等
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                rows += len(request[1])
+
+            self.run_batch(batch)
+            if stopping:
+                return
+
+    def run_batch(self, batch):
+        try:
+            inputs = np.concatenate([inputs for _, inputs in batch])
+            policy_preds, value_preds = self.model.predict(inputs)
+        except Exception as e:
+            for client_id, _ in batch:
+                self._responses[client_id].put(e)
+            return
+
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        self.num_rows += len(inputs)
+
+        offset = 0
+        for client_id, request_inputs in batch:
+            end = offset + len(request_inputs)
+            self._responses[client_id].put((policy_preds[offset:end], value_preds[offset:end]))
+            offset = end
+
+
+def test_inference_server():
+    class SumModel:
+        # 策略是每行输入之和, 价值是行号无关的常数, 用来检查结果有没有发错客户端
+        def __init__(self):
+            self.batch_sizes = []
+
+        def predict(self, inputs):
+            self.batch_sizes.append(len(inputs))
+            sums = inputs.reshape(len(inputs), -1).sum(axis=1, keepdims=True)
+            return sums, np.ones((len(inputs), 1), dtype=np.float32)
+
+    model = SumModel()
+    server = InferenceServer(model, max_batch_size=32, max_wait=0.05).start()
+    results = {}
+
+    def search_thread(i):
+        inputs = np.full((2, 10, 9, 9), i, dtype=np.float32)
+        results[i] = server.predict(inputs)
+
+    threads = [threading.Thread(target=search_thread, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.stop()
+
+    for i in range(8):
+        policy_pred, value_pred = results[i]
+        assert policy_pred.shape == (2, 1) and (policy_pred == i * 10 * 9 * 9).all()
+        assert value_pred.shape == (2, 1)
+    assert server.num_requests == 8 and server.num_rows == 16
+    assert server.num_batches == len(model.batch_sizes) < 8
+
+
+if __name__ == '__main__':
+    test_inference_server()
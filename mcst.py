@@ -6,13 +6,23 @@ from GameInterface import GameInterface
 
 
 class MCTSNode:
-    def __init__(self, state: (GameInterface, None, None), parent=None):
-        self.state = state
+    def __init__(self, state: (GameInterface, None, None), parent=None, move=None):
+        # a child is created with only its move and builds its state from its parent on first access
+        self._state = state
+        self.move = move
         self.parent = parent
         self.children = []
         self.visit_count = 0
         self.total_reward = 0
 
+    @property
+    def state(self):
+        if self._state is None:
+            board = self.parent.state[0].copy()
+            board.make_move(*self.move)
+            self._state = (board, *self.move)
+        return self._state
+
 
 class MCTS:
     def __init__(self, game: (GameInterface, None, None), is_red_turn):
@@ -35,9 +45,9 @@ class MCTS:
         # based on the rules of Chinese Chess and add them as children to the node.
 
         chess_board = node.state[0]
-        next_states = chess_board.generate_next_states()
-        for state in next_states:
-            child_node = MCTSNode(state, parent=node)
+        # 只记下合法走法, 不为每个走法复制棋盘
+        for move in chess_board.legal_moves():
+            child_node = MCTSNode(None, parent=node, move=move)
             node.children.append(child_node)
 
     def simulation(self, chess_board):
@@ -1,93 +1,253 @@
-import concurrent.futures
 import math
 import random
 import threading
+import time
+from collections import OrderedDict
 
 import numpy as np
 
-from ChineseChessBoard import ChineseChessBoard
+from ChineseChessBoard import ChineseChessBoard, decode_move, encode_move, to_square
+from encoder import board_to_tensor, boards_to_tensor
+
+
+class NodeStats:
+    """Visit statistics and network evaluation of one position.
+
+    Every TreeNode of the same position shares one NodeStats through the TranspositionTable.
+    """
+
+    def __init__(self):
+        self.visits = 0
+        self.score = 0
+        # 网络给出的走法和先验概率, 同一局面再次展开时不用再调用模型;
+        # moves 是整数走法的数组, 见 ChineseChessBoard.encode_move
+        self.moves = None
+        self.priors = None
+        self.value = None
+        self.lock = threading.RLock()
+
+
+class TranspositionTable:
+    """zobrist_key -> NodeStats, keeping at most max_size positions and dropping the least recently used.
+
+    A dropped NodeStats stays valid for the nodes that already use it; it can just no longer be found.
+    """
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            stats = self._entries.get(key)
+            if stats is not None:
+                self._entries.move_to_end(key)
+            return stats
+
+    def put(self, key, stats):
+        # 已经有别的节点登记过这个局面时保留先登记的那个
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = stats
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
 
 
 class TreeNode:
-    def __init__(self, board: ChineseChessBoard, parent, source, target, policy_pred=None):
-        # init associated board state
-        self.board = board
+    def __init__(self, board: ChineseChessBoard, parent, source, target, policy_pred=None, stats=None):
+        # init associated board state,
+        # a child may be created without a board and build it from its parent on first access
+        self._board = board
         self.source = source
         self.target = target
         # 概率
         self.probability = policy_pred
 
-        # init is node terminal flag
-        if self.board.game_over():
-            # we have a terminal node
-            self.is_terminal = True
-
-        # otherwise
-        else:
-            # we have a non-terminal node
-            self.is_terminal = False
+        # terminal flag, computed the first time the node is selected
+        self._is_terminal = None
 
         # init is fully expanded flag
-        self.is_fully_expanded = self.is_terminal
+        self.is_fully_expanded = False
 
         # init parent node if available
         self.parent = parent
 
-        # init the number of node visits
-        self.visits = 0
+        # visits, total score and network evaluation, shared with other nodes of the same position
+        self.stats = stats if stats is not None else NodeStats()
 
-        # init the total score of the node
-        self.score = 0
-
-        # init current node's children
+        # init current node's children, a child is only created the first time its move is selected;
+        # the moves and priors of all children are in stats.moves / stats.priors
         self.children = []
+        self.child_by_index = {}
 
         # virtual loss
         self.virtual_loss = 0
 
-        # for parallel search
-        self.lock = threading.RLock()
+    @property
+    def visits(self):
+        return self.stats.visits
+
+    @visits.setter
+    def visits(self, visits):
+        self.stats.visits = visits
+
+    @property
+    def score(self):
+        return self.stats.score
+
+    @score.setter
+    def score(self, score):
+        self.stats.score = score
+
+    @property
+    def lock(self):
+        # for parallel search, nodes of the same position share the lock of their stats
+        return self.stats.lock
+
+    @property
+    def board(self):
+        if self._board is None:
+            board = self.parent.board.copy()
+            board.make_move(self.source, self.target)
+            self._board = board
+        return self._board
+
+    @property
+    def is_terminal(self):
+        if self._is_terminal is None:
+            self._is_terminal = self.board.game_over()
+        return self._is_terminal
 
 
 class Mcst:
-    def __init__(self, model):
+    def __init__(self, model, transposition_table_size=50000, evaluation_cache=None, max_nodes=100000,
+                 num_threads=4, search_stats=None, tablebase=None):
         self.root = None
         self.model = model
+        # searchstats.SearchStats, 为 None 时不计时也不统计
+        self.search_stats = search_stats
+        # parallel_search 用的搜索线程, 第一次用到时创建, 之后每一步都复用
+        self.num_threads = num_threads
+        self._threads = []
+        self._work = threading.Condition()
+        self._remaining = 0
+        self._running = 0
+        self._deadline = None
+        self._closed = False
+        # 后台思考 (pondering) 的线程, 见 start_pondering
+        self._ponder_thread = None
+        self._ponder_stop = None
+        # 树里节点数的上限, 超出时剪掉访问次数少的分支, 为 None 时不限制
+        self.max_nodes = max_nodes
+        self.num_nodes = 0
+        # 不同走子顺序到达的同一局面共用访问统计和网络评估, 为 0 时不使用置换表
+        self.transpositions = TranspositionTable(transposition_table_size) if transposition_table_size else None
+        # evalcache.EvaluationCache, 可以在多盘棋和多个 Mcst 之间共用
+        self.evaluation_cache = evaluation_cache
+        # tablebase.Tablebase, 表里有的局面用确定的结果代替网络评估, 根节点在表里时直接按表走
+        self.tablebase = tablebase
+
+    def new_root(self, board):
+        stats = self.transpositions.get(board.zobrist_key) if self.transpositions is not None else None
+        self.num_nodes = 1
+        return TreeNode(board, None, None, None, None, stats)
 
     def update_root(self, source, target):
+        """Advance the root by a move of either side, keeping the subtree of that move."""
+        old_root = self.root
         # Find the child node corresponding to the selected move
-        for child in self.root.children:
-            if child.source == source and child.target == target:
-                self.root = child
-                self.root.parent = None
-                return
-        # If the move was not in the children of the root
-        # (which should not happen if the tree search is working correctly),
-        # fall back to creating a new tree
-        self.root = TreeNode(self.root.board.copy(), None, source, target, None)
+        child = self.find_child(old_root, source, target)
+        if child is None:
+            # The position was never evaluated or the move was not searched,
+            # start a new tree from the position after the move
+            board = old_root.board.copy()
+            board.make_move(source, target)
+            self.release(old_root)
+            self.root = self.new_root(board)
+            return
+
+        # the board is built from the parent, so materialize it before detaching
+        child.board
+        old_root.children.remove(child)
+        old_root.child_by_index = {}
+        child.parent = None
+        self.root = child
+        self.num_nodes -= self.release(old_root)
+        self.enforce_budget()
+
+    def release(self, node):
+        """Break the parent/children links of a detached subtree so it is freed right away.
+
+        Returns the number of nodes released.
+        """
+        released = 0
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children)
+            node.children = []
+            node.child_by_index = {}
+            node.parent = None
+            released += 1
+        return released
+
+    def enforce_budget(self):
+        # 只在没有未回传的路径时调用, 剪到上限的四分之三, 免得每一步都要剪
+        if self.max_nodes is not None and self.num_nodes > self.max_nodes:
+            self.prune(self.max_nodes * 3 // 4)
+
+    def prune(self, max_nodes):
+        """Cut the least visited branches until max_nodes nodes are left.
+
+        A pruned child is created again from its parent's moves and priors when it is selected,
+        and gets its statistics back from the transposition table if they are still there.
+        """
+        # 排序键是从根到节点路径上最少的访问次数, 子节点不会排在父节点后面; 相同时深的在前, 再按遍历顺序
+        nodes = []
+        keys = []
+        stack = [(child, 1, child.visits) for child in reversed(self.root.children)]
+        while stack:
+            node, depth, visits = stack.pop()
+            visits = min(visits, node.visits)
+            keys.append((visits, -depth, len(nodes)))
+            nodes.append(node)
+            stack.extend((child, depth + 1, visits) for child in reversed(node.children))
+        excess = len(nodes) + 1 - max_nodes
+        if excess <= 0:
+            self.num_nodes = len(nodes) + 1
+            return
+
+        # 排在前面的 excess 个节点连同它们的子树正好是 excess 个节点
+        removed = {nodes[key[2]] for key in sorted(keys)[:excess]}
+        for node in [node for node in removed if node.parent not in removed]:
+            parent = node.parent
+            parent.children = [child for child in parent.children if child not in removed]
+            parent.child_by_index = {index: child for index, child in parent.child_by_index.items()
+                                     if child not in removed}
+            self.release(node)
+        self.num_nodes = len(nodes) + 1 - excess
 
     def start(self, initial_state, num_searches):
 
         print(f"start search {num_searches} times.")
 
-        self.root = TreeNode(initial_state, None, None, None, None)
+        self.root = self.new_root(initial_state)
 
-        for _ in range(num_searches):
-            node = self.select(self.root)
-            self.backpropagate(node)
-            print(f"Loop {_ + 1}/{num_searches}")
-        try:
-            return self.get_best_move(self.root, 0)
-        except:
-            pass
+        return self.search(num_searches)
 
     def search(self, num_searches):
         print(f"search count: {num_searches}")
+        started = time.perf_counter()
         for _ in range(num_searches):
-            node = self.select(self.root)
-            self.backpropagate(node)
-
-            # print(f"Loop {_ + 1}/{num_searches}")
+            self.search_once()
+            self.enforce_budget()
+        self.record_search(started)
 
         try:
             return self.get_best_move(self.root, 0)
@@ -104,33 +264,117 @@ class Mcst:
                 return self.expand(node)
         return node
 
+    def is_evaluated(self, node):
+        # 子节点建好之后, 同一局面可能又在别的路径上评估过, 展开前换成置换表里的统计
+        if node.stats.priors is None and self.transpositions is not None:
+            stats = self.transpositions.get(node.board.zobrist_key)
+            if stats is not None:
+                node.stats = stats
+        return node.stats.priors is not None
+
     def expand(self, node):
+        evaluated = self.is_evaluated(node)
+        with node.lock:
+            # 等锁的时候别的线程可能已经评估过这个节点
+            if not evaluated and node.stats.priors is None:
+                # Get the policy and value predictions from the neural network
+                policy_pred, value = self.evaluate([node])[0]
+                self.set_evaluation(node, policy_pred, value)
+            return self.add_children(node)
+
+    def evaluate(self, nodes):
+        """(policy_pred, value) for each node, from the evaluation cache or from one model.predict call."""
+        results = [None] * len(nodes)
+        cache_keys = [None] * len(nodes)
+        missing = []
+        for i, node in enumerate(nodes):
+            if self.tablebase is not None:
+                value = self.tablebase.value(node.board)
+                if value is not None:
+                    # 胜负已定, 走法先验取均匀的
+                    results[i] = (UNIFORM_POLICY, value)
+                    continue
+            if self.evaluation_cache is not None:
+                cache_keys[i] = self.evaluation_cache.key(node.board, last_step(node))
+                results[i] = self.evaluation_cache.get(cache_keys[i])
+            if results[i] is None:
+                missing.append(i)
+
+        if missing:
+            search_stats = self.search_stats
+            started = time.perf_counter()
+            state_tensors = boards_to_tensor([nodes[i].board for i in missing], [last_step(nodes[i]) for i in missing])
+            if search_stats is not None:
+                encoded = time.perf_counter()
+                search_stats.add_phase('encode', encoded - started)
+            policy_preds, value_preds = self.model.predict(state_tensors)
+            if search_stats is not None:
+                search_stats.add_predict(len(missing), time.perf_counter() - encoded)
+            for j, i in enumerate(missing):
+                results[i] = (policy_preds[j], value_preds[j].item())
+                if self.evaluation_cache is not None:
+                    self.evaluation_cache.put(cache_keys[i], *results[i])
+        return results
+
+    def set_evaluation(self, node, policy_pred, value):
+        stats = node.stats
+        search_stats = self.search_stats
+        started = time.perf_counter()
+        moves = node.board.legal_move_codes()
+        if search_stats is not None:
+            search_stats.add_phase('movegen', time.perf_counter() - started)
+            search_stats.add_expansion(len(moves))
+        with stats.lock:
+            stats.moves = np.array(moves, dtype=np.intp)
+            stats.priors = legal_priors(policy_pred, stats.moves)
+            stats.value = value
+        # 只登记评估过的局面, 没走到过的子节点不占置换表
+        if self.transpositions is not None:
+            self.transpositions.put(node.board.zobrist_key, stats)
+
+    def add_children(self, node):
         with node.lock:
-            next_states = node.board.generate_next_states()
-
-            # Get the policy and value predictions from the neural network
-            state_tensor = to_tensor(node)
-            policy_pred, value_pred = self.model.predict(np.expand_dims(state_tensor, axis=0))
-            policy_pred = np.squeeze(policy_pred, axis=0)
-
-            for i, next_state in enumerate(next_states):
-                board, src, dst = next_state
-                probability = get_probability(src, dst, policy_pred)
-                child_node = TreeNode(board.copy(), node, src, dst, probability)
-
-                # Set the value of the node to the value prediction from the neural network
-                child_node.score = value_pred.item()
-
-                node.children.append(child_node)
-
             node.is_fully_expanded = True
 
-            if node.children:
+            if len(node.stats.moves):
                 # Select the child with the highest prior probability from the policy head
-                best_child = max(node.children, key=lambda child: child.probability)
+                best_child = self.child(node, int(np.argmax(node.stats.priors)))
+                # the simulation continues through this child, backpropagate takes the virtual loss back
+                with best_child.lock:
+                    best_child.virtual_loss += 1
                 return best_child
             return None
 
+    def child(self, node, index):
+        # 第 index 个走法的子节点, 第一次用到时才创建
+        with node.lock:
+            child_node = node.child_by_index.get(index)
+            if child_node is not None:
+                return child_node
+
+            stats = node.stats
+            src, dst = decode_move(stats.moves[index])
+            child_stats = None
+            if self.transpositions is not None:
+                child_stats = self.transpositions.get(node.board.key_after_move(src, dst))
+            # a position already in the table keeps its statistics,
+            # the value of a new child is added by backpropagate when it is first visited
+            child_node = TreeNode(None, node, src, dst, stats.priors[index].item(), child_stats)
+            self.num_nodes += 1
+
+            node.child_by_index[index] = child_node
+            node.children.append(child_node)
+            return child_node
+
+    def find_child(self, node, source, target):
+        # 按走法找子节点, 局面还没有评估过时返回 None
+        if node.stats.moves is None:
+            return None
+        indices = np.flatnonzero(node.stats.moves == encode_move(to_square(source), to_square(target)))
+        if not len(indices):
+            return None
+        return self.child(node, int(indices[0]))
+
     def rollout(self, board):
         # Here, you need to implement a function to simulate a complete game
         # and return the final reward based on the rules of Chinese Chess.
@@ -147,69 +391,353 @@ class Mcst:
         if node is None or node.probability is None:
             return
 
+        # 只回传这一次模拟的价值; 叶子可能从置换表拿到了别处累积的统计, 不能把它的 score 加到祖先上
+        value = self.leaf_value(node)
         with node.lock:
             node.visits += 1
             node.virtual_loss -= 1  # 搜索完成后把虚拟损失加回来
+            node.score += value
             prev = node.parent
+        # 叶子的深度, 用于统计
+        depth = 0
         while prev is not None:
             with prev.lock:
                 prev.visits += 1
-                prev.virtual_loss -= 1  # 搜索完成后把虚拟损失加回来
-                prev.score += node.score
+                # 搜索完成后把虚拟损失加回来, 根节点从来不加虚拟损失
+                if prev.parent is not None:
+                    prev.virtual_loss -= 1
+                prev.score += value
 
             prev = prev.parent
+            depth += 1
+        return depth
+
+    def leaf_value(self, node):
+        # 终局时是棋局的结果, 否则是这次模拟刚展开的父节点的网络评估
+        if node.is_terminal:
+            reward = node.board.get_final_reward()
+            return reward if reward is not None else 0
+        return node.parent.stats.value
 
     def get_best_move(self, node, exploration_constant):
         best_score = float('-inf')
         best_moves = []
 
+        # children have the opposite side to move, no need to build their boards
+        current_player = -1 if node.board.is_red_turn else 1
+
         try:
-            for child_node in node.children:
-                current_player = 1 if child_node.board.is_red_turn else -1
+            children = node.child_by_index
+            for index, probability in enumerate(node.stats.priors.tolist()):
+                # a move whose child has not been created yet has never been visited
+                child_node = children.get(index)
+                child_visits = child_node.visits if child_node is not None else 0
 
                 # puct = (score / N_i) + p * sqrt(total)/ (N_i + 1)
-                exploitation = (current_player * child_node.score / child_node.visits) if child_node.visits > 0 else 0
+                # 虚拟损失: 还没回传的模拟按输棋计入, 让并行或同一批的选择走不同的路径
+                visits = child_visits + child_node.virtual_loss if child_node is not None else 0
+                exploitation = ((current_player * child_node.score - child_node.virtual_loss) / visits) \
+                    if visits > 0 else 0
 
-                exploration_constant = exploration_constant / math.sqrt(1 + child_node.visits)
-                exploration = exploration_constant * child_node.probability * math.sqrt(node.visits) / (
-                            1 + child_node.visits)
+                # 每个子节点自己的探索系数, 不能改写 exploration_constant 影响后面的子节点
+                child_constant = exploration_constant / math.sqrt(1 + child_visits)
+                exploration = child_constant * probability * math.sqrt(node.visits) / (1 + visits)
 
                 move_score = exploitation + exploration
 
                 if move_score > best_score:
                     best_score = move_score
-                    best_moves = [child_node]
+                    best_moves = [index]
 
                 # found as good move as already available
                 elif move_score == best_score:
-                    best_moves.append(child_node)
+                    best_moves.append(index)
 
-            return random.choice(best_moves)
+            return self.child(node, random.choice(best_moves))
         except Exception as e:
             print("An exception occurred: ", e)
 
     def parallel_start(self, initial_state, num_searches):
         print(f"start search {num_searches} times.")
-        self.root = TreeNode(initial_state, None, None, None, None)
+        self.root = self.new_root(initial_state)
 
         return self.parallel_search(num_searches)
 
-    def parallel_search(self, num_searches):
-        print(f"search count: {num_searches}")
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self.search_once) for _ in range(num_searches)]
-            for i, future in enumerate(concurrent.futures.as_completed(futures)):
-                print(f"Loop {i + 1}/{num_searches}")
+    def parallel_search(self, num_searches, time_limit=None):
+        """Run num_searches simulations on the search threads, stopping early after time_limit seconds."""
+        print(f"search count: {num_searches}, threads: {self.num_threads}")
+        self.start_threads()
+        started = time.perf_counter()
+
+        with self._work:
+            self._remaining = num_searches
+            self._deadline = time.monotonic() + time_limit if time_limit is not None else None
+            self._work.notify_all()
+            while self._remaining > 0 or self._running:
+                self._work.wait()
+        self.enforce_budget()
+        self.record_search(started)
 
         try:
             return self.get_best_move(self.root, 0)
         except Exception as e:
             print("An exception occurred: ", e)
 
+    def start_threads(self):
+        if self._threads:
+            return
+        self._closed = False
+        for _ in range(self.num_threads):
+            thread = threading.Thread(target=self.search_loop, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        # 结束搜索线程
+        with self._work:
+            self._closed = True
+            self._work.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def search_loop(self):
+        # 每个搜索线程一直领取模拟, 直到模拟次数或时间用完, 再等下一次 parallel_search
+        while True:
+            with self._work:
+                while not self._closed:
+                    if self._deadline is not None and self._remaining > 0 and time.monotonic() >= self._deadline:
+                        self._remaining = 0
+                        self._work.notify_all()
+                    if self._remaining > 0:
+                        break
+                    self._work.wait()
+                if self._closed:
+                    return
+                self._remaining -= 1
+                self._running += 1
+
+            try:
+                self.search_once()
+            except Exception as e:
+                print("An exception occurred: ", e)
+            finally:
+                with self._work:
+                    self._running -= 1
+                    self._work.notify_all()
+
     def search_once(self):
-        node = self.select(self.root)
-        self.backpropagate(node)
+        if self.search_stats is None:
+            self.backpropagate(self.select(self.root))
+            return
+        node = self.timed_phase('select', self.select, self.root)
+        depth = self.timed_phase('backprop', self.backpropagate, node)
+        if depth is not None:
+            self.search_stats.add_simulation(depth)
+
+    def timed_phase(self, phase, function, *args):
+        # 记下 function 用的时间, 扣掉它里面已经记到别的阶段 (如展开叶子时的 predict) 的时间
+        search_stats = self.search_stats
+        inner = search_stats.inner_seconds()
+        started = time.perf_counter()
+        result = function(*args)
+        search_stats.add_phase(phase, time.perf_counter() - started - (search_stats.inner_seconds() - inner))
+        return result
+
+    def record_search(self, started):
+        if self.search_stats is not None:
+            self.search_stats.add_search(time.perf_counter() - started, self.num_nodes)
+            self.search_stats.maybe_log()
+
+    def batch_start(self, initial_state, num_searches, batch_size=16):
+        print(f"start search {num_searches} times.")
+        self.root = self.new_root(initial_state)
+
+        return self.batch_search(num_searches, batch_size)
+
+    def batch_search(self, num_searches, batch_size=16):
+        # 每轮选出至多 batch_size 个叶子, 一次 predict 全部评估后再一起回传
+        print(f"search count: {num_searches}, batch size: {batch_size}")
+        started = time.perf_counter()
+
+        done = 0
+        while done < num_searches:
+            count = self.batch_step(min(batch_size, num_searches - done))
+            if not count:
+                break
+            done += count
+        self.record_search(started)
+
+        try:
+            return self.get_best_move(self.root, 0)
+        except Exception as e:
+            print("An exception occurred: ", e)
+
+    def batch_step(self, batch_size):
+        # 选出一批叶子, 评估并回传, 返回完成的模拟次数, 0 表示已经没有可以搜索的叶子
+        search_stats = self.search_stats
+        if search_stats is None:
+            leaves, pending = self.select_batch(batch_size)
+        else:
+            leaves, pending = self.timed_phase('select', self.select_batch, batch_size)
+        if not leaves and not pending:
+            return 0
+
+        if pending:
+            for node, (policy_pred, value) in zip(pending, self.evaluate(pending)):
+                self.set_evaluation(node, policy_pred, value)
+                leaf = self.add_children(node)
+                if leaf is None:
+                    # 无子可走, 撤回这条路径的虚拟损失
+                    while node.parent is not None:
+                        node.virtual_loss -= 1
+                        node = node.parent
+                leaves.append(leaf)
+
+        if search_stats is None:
+            for leaf in leaves:
+                self.backpropagate(leaf)
+        else:
+            started = time.perf_counter()
+            depths = [self.backpropagate(leaf) for leaf in leaves]
+            search_stats.add_phase('backprop', time.perf_counter() - started)
+            for depth in depths:
+                if depth is not None:
+                    search_stats.add_simulation(depth)
+        self.enforce_budget()
+        return len(leaves)
+
+    def anytime_start(self, initial_state, num_searches=None, time_limit=None, batch_size=16):
+        print(f"start search, at most {num_searches} times in {time_limit} seconds.")
+        self.root = self.new_root(initial_state)
+
+        return self.anytime_search(num_searches, time_limit, batch_size)
+
+    def anytime_search(self, num_searches=None, time_limit=None, batch_size=16):
+        """Search until num_searches simulations or time_limit seconds are used, whichever comes first.
+
+        Stops early once the most visited root child can no longer be overtaken in the remaining budget
+        (estimated from the search speed so far when only time is limited), and returns that child.
+        A root covered by the tablebase returns the tablebase's move without searching.
+        """
+        assert num_searches is not None or time_limit is not None
+        print(f"search count: {num_searches}, time limit: {time_limit}, batch size: {batch_size}")
+
+        if self.tablebase is not None:
+            move = self.tablebase.best_move(self.root.board)
+            if move is not None:
+                print(f"tablebase move: {move}")
+                if not self.is_evaluated(self.root):
+                    self.backpropagate(self.expand(self.root))
+                return self.find_child(self.root, *move)
+
+        started = time.perf_counter()
+        done = 0
+        # 根节点的访问次数可能来自置换表, 至少要搜索到根节点有了子节点, 才有走法可以返回
+        while num_searches is None or done < num_searches or not (self.root.children or self.root.is_terminal):
+            elapsed = time.perf_counter() - started
+            if time_limit is not None and elapsed >= time_limit:
+                break
+
+            remaining = max(num_searches - done, 0) if num_searches is not None else None
+            if time_limit is not None and done:
+                remaining_by_time = int(done / elapsed * (time_limit - elapsed))
+                remaining = remaining_by_time if remaining is None else min(remaining, remaining_by_time)
+            if remaining is not None and self.is_decided(self.root, remaining):
+                break
+
+            count = self.batch_step(batch_size if remaining is None else min(batch_size, max(remaining, 1)))
+            if not count:
+                break
+            done += count
+
+        self.record_search(started)
+        print(f"searched {done} times in {time.perf_counter() - started:.2f} seconds")
+        return self.most_visited_child(self.root)
+
+    def start_pondering(self, num_searches=None, batch_size=16):
+        """Keep searching from the current root on a background thread until stop_pondering().
+
+        Meant for the opponent's time: stop pondering, update_root with the opponent's move, and the
+        subtree of that move keeps what was searched. Nothing else may use the tree in the meantime.
+        """
+        if self._ponder_thread is not None:
+            return
+        self._ponder_stop = threading.Event()
+        self._ponder_thread = threading.Thread(target=self.ponder, args=(self._ponder_stop, num_searches, batch_size),
+                                               daemon=True)
+        self._ponder_thread.start()
+
+    def stop_pondering(self):
+        if self._ponder_thread is None:
+            return
+        self._ponder_stop.set()
+        self._ponder_thread.join()
+        self._ponder_thread = None
+
+    def ponder(self, stop, num_searches, batch_size):
+        started = time.perf_counter()
+        done = 0
+        while not stop.is_set() and (num_searches is None or done < num_searches):
+            if self.root.is_terminal:
+                break
+            count = self.batch_step(batch_size if num_searches is None else min(batch_size, num_searches - done))
+            if not count:
+                break
+            done += count
+        self.record_search(started)
+
+    def is_decided(self, node, remaining):
+        # 剩下的模拟全给第二名也追不上第一名时, 再搜索不会改变结果
+        if node.stats.moves is None or not node.children:
+            return False
+        if len(node.stats.moves) <= 1:
+            return True
+        visits = sorted((child.visits for child in node.children), reverse=True) + [0, 0]
+        return visits[0] - visits[1] > remaining
+
+    def most_visited_child(self, node):
+        if not node.children:
+            return None
+        return max(node.children, key=lambda child: child.visits)
+
+    def select_batch(self, batch_size):
+        """Walk down from the root batch_size times with virtual loss.
+
+        Returns the leaves that can be backed up right away (terminal nodes, and children of nodes
+        whose position was already evaluated) and the unexpanded nodes that need a network evaluation.
+        """
+        leaves = []
+        pending = []
+        for _ in range(batch_size):
+            node = self.root
+            path = []
+            while not node.is_terminal and node.is_fully_expanded:
+                node = self.get_best_move(node, 2)
+                if node is None:
+                    break
+                node.virtual_loss += 1
+                path.append(node)
+
+            if node is None or (not node.is_terminal and any(node.stats is other.stats for other in pending)):
+                # 没有可走的子节点, 或者撞上了这一批里已经要评估的局面, 撤回这条路径的虚拟损失
+                for visited in path:
+                    visited.virtual_loss -= 1
+                continue
+
+            if node.is_terminal:
+                leaves.append(node)
+            elif self.is_evaluated(node):
+                # 置换表里已经有这个局面的评估, 直接展开
+                leaf = self.add_children(node)
+                if leaf is None:
+                    for visited in path:
+                        visited.virtual_loss -= 1
+                    continue
+                leaves.append(leaf)
+            else:
+                pending.append(node)
+        return leaves, pending
 
 
 def create_uci_labels():
@@ -258,65 +786,73 @@ def to_uci_label(src, dst):
 uci_labels = create_uci_labels()
 
 
+def _build_move_labels():
+    # 整数走法 -> 策略输出的下标, 不在 uci_labels 里的走法为 -1
+    index_by_label = {label: index for index, label in enumerate(uci_labels)}
+    move_labels = np.full(90 * 90, -1, dtype=np.intp)
+    for move in range(90 * 90):
+        label = to_uci_label(*decode_move(move))
+        if label in index_by_label:
+            move_labels[move] = index_by_label[label]
+    return move_labels
+
+
+MOVE_TO_LABEL = _build_move_labels()
+# 不用网络评估的局面 (残局库) 的策略, 合法走法的先验都一样
+UNIFORM_POLICY = np.zeros(len(uci_labels), dtype=np.float32)
+
+
+def move_labels(moves):
+    # 整数走法在策略输出里的下标, 没有标签的走法不能静默地读到最后一个输出
+    labels = MOVE_TO_LABEL[moves]
+    if np.any(labels < 0):
+        missing = np.atleast_1d(moves)[np.atleast_1d(labels) < 0]
+        raise ValueError(f'moves without a policy label: {[decode_move(int(move)) for move in missing]}')
+    return labels
+
+
 def get_probability(src, dst, policy_pred):
-    # Convert the source and destination coordinates to a UCI label
-    uci_label = to_uci_label(src, dst)
+    # Find the index of the UCI label of the move in the policy prediction vector
+    return policy_pred[move_labels(encode_move(to_square(src), to_square(dst)))]
+
+
+def legal_priors(policy_pred, moves):
+    """Softmax of the policy head's logits over the legal moves only.
 
-    # Create the UCI labels array
-    # Find the index of the UCI label in the labels array
-    label_index = uci_labels.index(uci_label)
+    moves is an array of integer moves; the result is aligned with it.
+    Raises ValueError for a move that has no policy label.
+    """
+    if not len(moves):
+        return np.zeros(0, dtype=np.float32)
+    logits = np.asarray(policy_pred, dtype=np.float32)[move_labels(moves)]
+    exp = np.exp(logits - logits.max())
+    return exp / exp.sum()
 
-    # Get the probability from the policy prediction vector
-    probability = policy_pred[label_index]
 
-    return probability
+def last_step(node: TreeNode):
+    # 输入的最后一步平面用的是父节点的走法
+    parent = node.parent
+    if parent is None or parent.source is None:
+        return None
+    return parent.source, parent.target
 
 
 def to_tensor(node: TreeNode):
-    # one-hot representation for each piece
-    brd = node.board
-    turn = 1 if brd.is_red_turn else 0
+    return board_to_tensor(node.board, last_step(node))
 
-    parent = node.parent
-    last_step = (parent.source, parent.target) if parent is not None else None
-
-    piece_to_onehot = {
-        'R': np.array([1, 0, 0, 0, 0, 0, 0]),
-        'N': np.array([0, 1, 0, 0, 0, 0, 0]),
-        'B': np.array([0, 0, 1, 0, 0, 0, 0]),
-        'A': np.array([0, 0, 0, 1, 0, 0, 0]),
-        'K': np.array([0, 0, 0, 0, 1, 0, 0]),
-        'C': np.array([0, 0, 0, 0, 0, 1, 0]),
-        'P': np.array([0, 0, 0, 0, 0, 0, 1]),
-        'r': np.array([-1, 0, 0, 0, 0, 0, 0]),
-        'n': np.array([0, -1, 0, 0, 0, 0, 0]),
-        'b': np.array([0, 0, -1, 0, 0, 0, 0]),
-        'a': np.array([0, 0, 0, -1, 0, 0, 0]),
-        'k': np.array([0, 0, 0, 0, -1, 0, 0]),
-        'c': np.array([0, 0, 0, 0, 0, -1, 0]),
-        'p': np.array([0, 0, 0, 0, 0, 0, -1]),
-        '_': np.array([0, 0, 0, 0, 0, 0, 0])
-    }
-
-    # create an empty tensor
-    tensor = np.zeros((10, 9, 9))  # the dimension of the tensor is (10, 9, 9)
-
-    # fill in the tensor with one-hot encoding of the pieces
-    for i in range(10):
-        for j in range(9):
-            tensor[i, j, :7] = piece_to_onehot[brd.board[i][j]]
-
-    # fill in the tensor with the last move
-    if last_step is not None:
-        source, target = last_step
-        if source is not None and target is not None:
-            tensor[source[0], source[1], 7] = -1
-            tensor[target[0], target[1], 7] = 1
-
-    # fill in the tensor with the current turn
-    tensor[:, :, 8] = turn
-
-    return tensor
+
+class _UniformModel:
+    # 测试用的模型: 策略全为 0, 价值都是 value, 记下 predict 调用的次数, delay 模拟推理的耗时
+    def __init__(self, delay=0, value=0):
+        self.delay = delay
+        self.value = value
+        self.calls = 0
+
+    def predict(self, state_tensors):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return np.zeros((len(state_tensors), len(uci_labels))), np.full((len(state_tensors), 1), self.value)
 
 
 def test_to_tensor():
@@ -343,8 +879,330 @@ def test_uci():
     assert to_uci_label((2, 1), (5, 1)) == 'b7b4', "Error in test case 4"
     assert to_uci_label((3, 0), (4, 0)) == 'a6a5', "Error in test case 5"
 
+    # 每个标签都有对应的整数走法, 查表与按字符串查找一致
+    assert sorted(MOVE_TO_LABEL[MOVE_TO_LABEL >= 0]) == list(range(len(uci_labels)))
+    policy_pred = np.arange(len(uci_labels), dtype=np.float32)
+    assert get_probability((0, 1), (2, 2), policy_pred) == uci_labels.index('b9c7')
+
+    # 先验只在合法走法上做 softmax, 顺序与 legal_moves 相同
+    board = ChineseChessBoard()
+    moves = np.array(board.legal_move_codes())
+    priors = legal_priors(policy_pred * 0.01, moves)
+    assert [decode_move(move) for move in moves] == board.legal_moves()
+    assert priors.shape == (44,) and abs(priors.sum() - 1) < 1e-6
+    expected = [get_probability(src, dst, policy_pred) for src, dst in board.legal_moves()]
+    assert (np.argsort(priors, kind='stable') == np.argsort(expected, kind='stable')).all()
+
+    # 没有标签的走法 (如车走马步) 直接报错
+    for bad_moves in (np.append(moves, encode_move(0, 10)), np.array([encode_move(0, 10)])):
+        try:
+            legal_priors(policy_pred, bad_moves)
+        except ValueError:
+            pass
+        else:
+            assert False, 'a move without a label must not get a prior'
+
+
+def test_transposition_table():
+    def child(node, source, target):
+        return mcst.find_child(node, source, target)
+
+    model = _UniformModel()
+    mcst = Mcst(model)
+    mcst.root = mcst.new_root(ChineseChessBoard())
+
+    # 黑马、红马、黑另一只马, 换一个顺序走到同一个局面
+    moves = [((0, 1), (2, 2)), ((9, 1), (7, 2)), ((0, 7), (2, 6))]
+    nodes = []
+    for order in (moves, [moves[2], moves[1], moves[0]]):
+        node = mcst.root
+        for source, target in order:
+            if not node.is_fully_expanded:
+                mcst.expand(node)
+            node = child(node, source, target)
+        nodes.append(node)
+
+    first, second = nodes
+    assert first is not second and first.board.zobrist_key == second.board.zobrist_key
+    mcst.expand(first)
+    calls = model.calls
+
+    # 第二条路径上的同一局面直接用第一次的评估, 统计也是同一份
+    mcst.expand(second)
+    assert model.calls == calls
+    assert second.stats is first.stats
+    assert second.stats.moves is first.stats.moves
+
+    # 之后再展开的孙节点在置换表里能找到的, 也共用统计
+    grandchild = first.children[0]
+    mcst.expand(grandchild)
+    other = child(second, grandchild.source, grandchild.target)
+    assert mcst.is_evaluated(other) and other.stats is grandchild.stats
+
+
+def test_transposed_leaf():
+    def nodes(node):
+        yield node
+        for child in node.children:
+            yield from nodes(child)
+
+    # 置换表里的局面做叶子时, 祖先只加上这一次模拟的价值
+    mcst = Mcst(_UniformModel(value=0.5))
+    mcst.root = mcst.new_root(ChineseChessBoard())
+    moves = [((0, 1), (2, 2)), ((9, 1), (7, 2)), ((0, 7), (2, 6))]
+    node = mcst.root
+    for source, target in moves:
+        mcst.expand(node)
+        node = mcst.find_child(node, source, target)
+    mcst.expand(node)
+    for _ in range(20):
+        node.virtual_loss += 1
+        mcst.backpropagate(node)
+    assert node.visits == 20 and node.score == 10
+
+    node = mcst.root
+    for source, target in [moves[2], moves[1]]:
+        mcst.expand(node)
+        node = mcst.find_child(node, source, target)
+    mcst.expand(node)
+    leaf = mcst.find_child(node, *moves[0])
+    assert leaf.visits == 20
+    visits, score = node.visits, node.score
+    leaf.virtual_loss += 1
+    mcst.backpropagate(leaf)
+    assert node.visits == visits + 1 and node.score == score + 0.5
+    assert leaf.visits == 21 and leaf.score == 10.5
+
+    # 自对弈多步之后, 每个节点的平均分仍不超过单次模拟的价值
+    mcst = Mcst(_UniformModel(value=0.5))
+    node = mcst.anytime_start(ChineseChessBoard(), 64, batch_size=8)
+    for _ in range(12):
+        mcst.update_root(node.source, node.target)
+        node = mcst.anytime_search(64, batch_size=8)
+    assert all(abs(node.score) <= node.visits for node in nodes(mcst.root))
+
+
+def test_lazy_children():
+    mcst = Mcst(_UniformModel())
+    mcst.root = mcst.new_root(ChineseChessBoard())
+    leaf = mcst.expand(mcst.root)
+
+    # 展开只记下 44 个走法和先验, 只建出被选中的那一个子节点
+    assert len(mcst.root.stats.moves) == 44 and mcst.root.stats.priors.shape == (44,)
+    assert mcst.root.children == [leaf]
+
+    mcst.backpropagate(leaf)
+    node = mcst.get_best_move(mcst.root, 2)
+    assert node is not leaf and len(mcst.root.children) == 2
+    assert mcst.find_child(mcst.root, node.source, node.target) is node
+
+
+def test_batch_search():
+    def nodes(node):
+        yield node
+        for child in node.children:
+            yield from nodes(child)
+
+    model = _UniformModel()
+    mcst = Mcst(model)
+    node = mcst.batch_start(ChineseChessBoard(), 200, 16)
+
+    # 每次模拟都回传到根节点, 且只经过根节点的一个子节点
+    assert mcst.root.visits == 200
+    assert sum(child.visits for child in mcst.root.children) == 200
+    assert node in mcst.root.children
+    # 一批叶子只调用一次模型
+    assert model.calls < 200 // 4
+    # 回传之后所有路径上的虚拟损失都撤回了
+    assert all(node.virtual_loss == 0 for node in nodes(mcst.root))
+
+    mcst.batch_search(50, 8)
+    assert mcst.root.visits == 250
+    assert all(node.virtual_loss == 0 for node in nodes(mcst.root))
+
+
+def test_tree_reuse():
+    def count_nodes(node):
+        return 1 + sum(count_nodes(child) for child in node.children)
+
+    # 搜索中超出上限就剪枝, num_nodes 与树里的节点数一致
+    mcst = Mcst(_UniformModel(), max_nodes=200)
+    node = mcst.batch_start(ChineseChessBoard(), 600, 8)
+    assert mcst.root.visits == 600
+    assert count_nodes(mcst.root) == mcst.num_nodes <= 200
+
+    # 换根保留选中的子树, 兄弟节点立即断开
+    old_root = mcst.root
+    visits = node.visits
+    mcst.update_root(node.source, node.target)
+    assert mcst.root is node and node.parent is None and node.visits == visits
+    assert old_root.children == [] and count_nodes(node) == mcst.num_nodes
+
+    # 走法不在树里时, 新根是走了这一步之后的局面
+    board = ChineseChessBoard()
+    mcst.root = mcst.new_root(board.copy())
+    mcst.update_root((0, 1), (2, 2))
+    board.make_move((0, 1), (2, 2))
+    assert mcst.root.board.zobrist_key == board.zobrist_key and mcst.num_nodes == 1
+
+
+def test_prune():
+    def count_nodes(node):
+        return 1 + sum(count_nodes(child) for child in node.children)
+
+    mcst = Mcst(_UniformModel(), max_nodes=None)
+    mcst.batch_start(ChineseChessBoard(), 600, 8)
+    total = count_nodes(mcst.root)
+    best = mcst.most_visited_child(mcst.root)
+
+    # 访问次数相同的节点很多, 也只剪掉超出的部分
+    budget = total * 3 // 4
+    mcst.prune(budget)
+    assert count_nodes(mcst.root) == mcst.num_nodes == budget
+    assert best in mcst.root.children
+    assert all(child.parent is node for node in [mcst.root] + mcst.root.children for child in node.children)
+
+    # 留下的是访问最多的分支
+    children = list(mcst.root.children)
+    mcst.prune(10)
+    assert count_nodes(mcst.root) == mcst.num_nodes == 10
+    kept = mcst.root.children
+    assert len(kept) == 9
+    assert min(child.visits for child in kept) >= max(child.visits for child in children if child not in kept)
+
+
+def test_parallel_search():
+    def nodes(node):
+        yield node
+        for child in node.children:
+            yield from nodes(child)
+
+    mcst = Mcst(_UniformModel(delay=0.001), num_threads=4)
+    mcst.parallel_start(ChineseChessBoard(), 200)
+    threads = list(mcst._threads)
+    assert mcst.root.visits == 200 and len(threads) == 4
+    # 回传之后所有路径上的虚拟损失都撤回了
+    assert all(node.virtual_loss == 0 for node in nodes(mcst.root) if node is not mcst.root)
+
+    # 同一批线程接着搜索, 时间用完就提前停下
+    mcst.parallel_search(100000, time_limit=0.2)
+    assert 200 < mcst.root.visits < 100200
+    assert mcst._threads == threads and all(thread.is_alive() for thread in threads)
+    mcst.close()
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_anytime_search():
+    class PreferModel(_UniformModel):
+        # 只偏好一个走法, 其他走法的价值更低, 很快就能决定
+        def predict(self, state_tensors):
+            policy, value = super().predict(state_tensors)
+            policy[:, uci_labels.index('b9c7')] = 10
+            return policy, value
+
+    # 第一名领先得足够多时提前停下, 返回访问最多的子节点
+    mcst = Mcst(PreferModel())
+    node = mcst.anytime_start(ChineseChessBoard(), num_searches=2000, batch_size=8)
+    assert mcst.root.visits < 2000
+    assert (node.source, node.target) == ((0, 1), (2, 2))
+    assert node is mcst.most_visited_child(mcst.root)
+
+    # 只限时间
+    mcst = Mcst(_UniformModel())
+    started = time.monotonic()
+    node = mcst.anytime_start(ChineseChessBoard(), time_limit=0.3)
+    assert node is not None and time.monotonic() - started < 1.0
+
+
+def test_search_stats():
+    import io
+    import json
+    from searchstats import SearchStats
+
+    log_file = io.StringIO()
+    search_stats = SearchStats(log_file, log_interval=0)
+    mcst = Mcst(_UniformModel(), search_stats=search_stats)
+    mcst.batch_start(ChineseChessBoard(), 200, 8)
+    mcst.parallel_search(100)
+    mcst.close()
+
+    # 每次模拟都记下了, 各阶段都有计时, 每次搜索结束写一行 JSON
+    snapshot = search_stats.snapshot()
+    assert snapshot['simulations'] == mcst.root.visits == 300
+    assert all(seconds > 0 for seconds in snapshot['phase_seconds'].values())
+    assert snapshot['max_depth'] >= 1 and snapshot['branching_factor'] > 0
+    assert snapshot['batch_sizes']['1'] >= 1 and snapshot['num_nodes'] == mcst.num_nodes
+    lines = [json.loads(line) for line in log_file.getvalue().splitlines()]
+    assert len(lines) == 2 and lines[-1]['simulations'] == 300
+
+
+def test_pondering():
+    mcst = Mcst(_UniformModel(delay=0.001))
+    node = mcst.anytime_start(ChineseChessBoard(), 100)
+    mcst.update_root(node.source, node.target)
+
+    # 对手思考的时候接着搜索, 对手走子后保留那一步的子树
+    visits = mcst.root.visits
+    mcst.start_pondering()
+    time.sleep(0.3)
+    mcst.stop_pondering()
+    assert mcst.root.visits > visits + 16
+
+    reply = mcst.most_visited_child(mcst.root)
+    reply_visits = reply.visits
+    mcst.update_root(reply.source, reply.target)
+    assert mcst.root is reply and mcst.root.visits == reply_visits > 0
+
+    # 有次数上限时自己停下
+    mcst.start_pondering(num_searches=32, batch_size=8)
+    mcst._ponder_thread.join()
+    mcst.stop_pondering()
+    assert mcst.root.visits == reply_visits + 32
+
+
+def test_tablebase_search():
+    import os
+    import tempfile
+    from ChineseChessBoard import KING, ROOK
+    from tablebase import Tablebase, solve, write_tablebase
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'krk.cctb')
+        write_tablebase(path, solve(['KRvK']))
+        tablebase = Tablebase(path)
+
+        # 根节点在表里: 不搜索也不调用网络, 直接走表里最快将死的一步
+        squares = [0] * 90
+        squares[4], squares[84], squares[36] = -KING, KING, ROOK
+        board = ChineseChessBoard.from_squares(squares, is_red_turn=True)
+        model = _UniformModel()
+        mcst = Mcst(model, tablebase=tablebase)
+        node = mcst.anytime_start(board, num_searches=100)
+        assert (node.source, node.target) == tablebase.best_move(board)
+        assert model.calls == 0 and tablebase.probe(node.board)[0] == 'loss'
+        assert node.parent is mcst.root
+
+        # 表里的叶子用确定的结果, 红胜是 1
+        leaf = TreeNode(node.board, None, None, None)
+        (policy_pred, value), = mcst.evaluate([leaf])
+        assert value == 1 and not policy_pred.any() and model.calls == 0
+        mcst.evaluate([TreeNode(ChineseChessBoard(), None, None, None)])
+        assert model.calls == 1
+        del tablebase, mcst, node, leaf
+
 
 if __name__ == '__main__':
     test_to_tensor()
     test_uci()
+    test_transposition_table()
+    test_transposed_leaf()
+    test_lazy_children()
+    test_batch_search()
+    test_tree_reuse()
+    test_prune()
+    test_parallel_search()
+    test_anytime_search()
+    test_search_stats()
+    test_pondering()
+    test_tablebase_search()
     exit()
@@ -0,0 +1,129 @@
+import argparse
+import ast
+import time
+
+from ChineseChessBoard import ChineseChessBoard
+
+# 参考值: 开局局面与 records/ 中几个对局的局面, 格式为 (名称, encode() 字符串, 是否红方走, {深度: 叶子数})
+# 开局的数值与公开的象棋 perft 结果一致 (黑方先走, 与红方先走对称)
+REFERENCE_POSITIONS = [
+    ('start',
+     ChineseChessBoard().encode(), False,
+     {1: 44, 2: 1920, 3: 79666, 4: 3290240}),
+    ('record_20230730-110250:20',
+     'r_bakabnr_____c___n__________p_p_p_ppC_______P__________P_P_P_P______CR_R______c__NBAKABN_', True,
+     {1: 55, 2: 2192, 3: 115864}),
+    ('record_20230730-110250:45',
+     'r_b_kar______an___________b____pcp__pn_CP____P_p____p___P___P_P____B____R___A_CR__NB_KA_N_', False,
+     {1: 38, 2: 1581, 3: 60650}),
+    ('record_20230730-110250:80',
+     '____kab_____ran______C___r_____p_pR_PnbP_c______p__P_p__P_____P____B__CN___RA______BKNA___', True,
+     {1: 42, 2: 1688, 3: 71181}),
+    ('record_20230730-110250:120',
+     '_n___abn____rkr______a___C_______p____P_p_P_______c______p____p__RAB__________N____BKNA___', True,
+     {1: 34, 2: 1243, 3: 41402}),
+    ('record_20230730-110250:200',
+     '_____a______ka________b_____n________P__N_p____pr___________cRn___KB__N________C____A_____', True,
+     {1: 1, 2: 31, 3: 770}),
+]
+
+
+def perft(board, depth):
+    """Count the leaf nodes of the legal move tree, walking one board with make/unmake."""
+    moves = board.legal_moves()
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+
+    nodes = 0
+    for src, dst in moves:
+        board.make_move(src, dst)
+        nodes += perft(board, depth - 1)
+        board.unmake_move()
+    return nodes
+
+
+def divide(board, depth):
+    """Leaf counts below each root move, for finding which move a generator gets wrong."""
+    counts = {}
+    for src, dst in board.legal_moves():
+        board.make_move(src, dst)
+        counts[(src, dst)] = perft(board, depth - 1)
+        board.unmake_move()
+    return counts
+
+
+def load_record_positions(filename):
+    """Read positions from a self-play record file written by aiplay.save_game_record."""
+    positions = []
+    with open(filename, 'r') as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('-'):
+                continue
+            encoded, rest = line.split(',', 1)
+            move = ast.literal_eval(rest.rsplit(',', 1)[0])
+            # 记录的是走完这一步之后的局面, 走子方是刚走的那颗棋子的对方
+            target_x, target_y = move[1]
+            is_red_turn = encoded[target_x * 9 + target_y].islower()
+            positions.append((f"{filename}:{number}", encoded, is_red_turn, {}))
+    return positions
+
+
+def run(positions, max_depth):
+    total_nodes = 0
+    total_time = 0.0
+    failures = 0
+
+    for name, encoded, is_red_turn, reference in positions:
+        board = ChineseChessBoard.decode(encoded, is_red_turn)
+        for depth in range(1, max_depth + 1):
+            start = time.perf_counter()
+            nodes = perft(board, depth)
+            elapsed = time.perf_counter() - start
+            total_nodes += nodes
+            total_time += elapsed
+
+            expected = reference.get(depth)
+            if expected is None:
+                status = ''
+            elif expected == nodes:
+                status = 'ok'
+            else:
+                status = f'MISMATCH (expected {expected})'
+                failures += 1
+
+            nps = nodes / elapsed if elapsed > 0 else float('inf')
+            print(f"{name} depth {depth}: {nodes} nodes, {elapsed:.3f}s, {nps:,.0f} nodes/s {status}")
+
+    if total_time > 0:
+        print(f"total: {total_nodes} nodes, {total_time:.3f}s, {total_nodes / total_time:,.0f} nodes/s")
+    return failures
+
+
+def test_perft():
+    for name, encoded, is_red_turn, reference in REFERENCE_POSITIONS:
+        board = ChineseChessBoard.decode(encoded, is_red_turn)
+        for depth in (1, 2):
+            assert perft(board, depth) == reference[depth], (name, depth)
+        # make/unmake 之后局面不变
+        assert board.encode() == encoded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='perft move generator check and benchmark')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--records', nargs='*', default=[],
+                        help='also run the positions of these record files (no reference values)')
+    parser.add_argument('--divide', action='store_true', help='print the per-move counts of the start position')
+    args = parser.parse_args()
+
+    if args.divide:
+        for move, count in sorted(divide(ChineseChessBoard(), args.depth).items()):
+            print(move, count)
+        exit()
+
+    positions = list(REFERENCE_POSITIONS)
+    for filename in args.records:
+        positions.extend(load_record_positions(filename))
+
+    exit(1 if run(positions, args.depth) else 0)
@@ -0,0 +1,255 @@
+import contextlib
+import io
+import multiprocessing
+import random
+
+import numpy as np
+
+from ChineseChessBoard import ChineseChessBoard
+from mcstx import Mcst, uci_labels
+
+
+class MergedNode:
+    """A root child (or the root) with the statistics summed over all workers' trees."""
+
+    def __init__(self, board, source, target, visits, score):
+        self.board = board
+        self.source = source
+        self.target = target
+        self.visits = visits
+        self.score = score
+
+    @property
+    def is_terminal(self):
+        return self.board.game_over()
+
+
+def _root_summary(mcst):
+    root = mcst.root
+    return root.visits, root.score, [(child.source, child.target, child.visits, child.score)
+                                     for child in root.children if child.visits]
+
+
+def _board_message(board):
+    # 连同很长的局面历史一起 pickle 会递归过深, 只发局面和判重复时会看到的那几步历史
+    history = []
+    entry = board._history
+    for _ in range(board.num_steps_no_capture):
+        if entry is None:
+            break
+        history.append(entry[:2])
+        entry = entry[2]
+    return board.squares, board.is_red_turn, board.num_steps_no_capture, history
+
+
+def _board_from_message(squares, is_red_turn, num_steps_no_capture, history):
+    board = ChineseChessBoard.from_squares(squares, is_red_turn)
+    board.num_steps_no_capture = num_steps_no_capture
+    for key, in_check in reversed(history):
+        board._history = (key, in_check, board._history)
+    return board
+
+
+def _search_worker(model, connection, seed, batch_size, quiet):
+    # 每个进程有自己的随机种子, 同样的根节点也会长出不同的树
+    random.seed(seed)
+    np.random.seed(seed)
+    mcst = Mcst(model)
+
+    while True:
+        command, args = connection.recv()
+        if command == 'stop':
+            connection.close()
+            return
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+                if command == 'start':
+                    message, num_searches = args
+                    mcst.batch_start(_board_from_message(*message), num_searches, batch_size)
+                elif command == 'search':
+                    mcst.batch_search(args[0], batch_size)
+                elif command == 'anytime_start':
+                    message, num_searches, time_limit = args
+                    mcst.anytime_start(_board_from_message(*message), num_searches, time_limit, batch_size)
+                elif command == 'anytime_search':
+                    mcst.anytime_search(*args, batch_size)
+                elif command == 'update_root':
+                    mcst.update_root(*args)
+            connection.send(_root_summary(mcst))
+        except Exception as e:
+            connection.send(e)
+
+
+class RootParallelMcst:
+    """Root-parallel search: each worker process grows its own Mcst from the same root, and the visits and
+    scores of the root children are summed over the workers after every call.
+
+    Tree traversal and move generation hold the GIL, so processes scale where threads do not. The model is
+    either an inference.InferenceServer, whose clients are handed to the workers, or a picklable model.
+    It offers the search calls of Mcst that aiplay uses: start/search, batch_*, anytime_* and update_root.
+    """
+
+    def __init__(self, model, num_workers=4, batch_size=16, seed=0, quiet=True):
+        self.num_workers = num_workers
+        self.root_board = None
+        self.visits = 0
+        self.score = 0
+        self.children = []
+        self._connections = []
+        self._processes = []
+
+        for i in range(num_workers):
+            worker_model = model.client(for_process=True) if hasattr(model, 'client') else model
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_search_worker,
+                                              args=(worker_model, worker_connection, seed + i, batch_size, quiet),
+                                              daemon=True)
+            process.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(('stop', ()))
+            connection.close()
+        for process in self._processes:
+            process.join()
+        self._connections = []
+        self._processes = []
+
+    @property
+    def root(self):
+        return MergedNode(self.root_board, None, None, self.visits, self.score)
+
+    def _broadcast(self, commands):
+        for connection, command in zip(self._connections, commands):
+            connection.send(command)
+        summaries = [connection.recv() for connection in self._connections]
+        for summary in summaries:
+            if isinstance(summary, Exception):
+                raise summary
+        self._merge(summaries)
+
+    def _merge(self, summaries):
+        self.visits = sum(visits for visits, _, _ in summaries)
+        self.score = sum(score for _, score, _ in summaries)
+        merged = {}
+        for _, _, children in summaries:
+            for source, target, visits, score in children:
+                stats = merged.setdefault((source, target), [0, 0])
+                stats[0] += visits
+                stats[1] += score
+        self.children = [(source, target, visits, score) for (source, target), (visits, score) in merged.items()]
+
+    def _split(self, num_searches):
+        # 总的模拟次数平均分给各个进程, 不限次数时每个进程都不限
+        if num_searches is None:
+            return [None] * self.num_workers
+        share, extra = divmod(max(num_searches, 0), self.num_workers)
+        return [share + (1 if i < extra else 0) for i in range(self.num_workers)]
+
+    def start(self, initial_state, num_searches):
+        print(f"start search {num_searches} times on {self.num_workers} processes.")
+        self.root_board = initial_state.copy()
+        message = _board_message(self.root_board)
+        self._broadcast([('start', (message, share)) for share in self._split(num_searches)])
+        return self.best_move()
+
+    def search(self, num_searches):
+        print(f"search count: {num_searches} on {self.num_workers} processes")
+        self._broadcast([('search', (share,)) for share in self._split(num_searches)])
+        return self.best_move()
+
+    # 与 Mcst 相同的接口, 批大小在创建时给定
+    def batch_start(self, initial_state, num_searches, batch_size=None):
+        return self.start(initial_state, num_searches)
+
+    def batch_search(self, num_searches, batch_size=None):
+        return self.search(num_searches)
+
+    def anytime_start(self, initial_state, num_searches=None, time_limit=None, batch_size=None):
+        # 每个进程各自搜索到分到的次数或 time_limit 秒, 以及各自提前停下
+        print(f"start search, at most {num_searches} times in {time_limit} seconds on {self.num_workers} processes.")
+        self.root_board = initial_state.copy()
+        message = _board_message(self.root_board)
+        self._broadcast([('anytime_start', (message, share, time_limit)) for share in self._split(num_searches)])
+        return self.best_move()
+
+    def anytime_search(self, num_searches=None, time_limit=None, batch_size=None):
+        print(f"search count: {num_searches}, time limit: {time_limit} on {self.num_workers} processes")
+        self._broadcast([('anytime_search', (share, time_limit)) for share in self._split(num_searches)])
+        return self.best_move()
+
+    def best_move(self):
+        # 合并后按访问次数选, 各棵树的平均分在访问少时误差大
+        if not self.children:
+            return None
+        source, target, visits, score = max(self.children, key=lambda child: child[2])
+        board = self.root_board.copy()
+        board.make_move(source, target)
+        return MergedNode(board, source, target, visits, score)
+
+    def update_root(self, source, target):
+        # 每个进程各自换根, 保留自己的子树
+        self.root_board = self.root_board.copy()
+        self.root_board.make_move(source, target)
+        self._broadcast([('update_root', (source, target))] * self.num_workers)
+
+
+class _SinModel:
+    # 测试用的模型, 放在模块里才能传给子进程
+    def predict(self, state_tensors):
+        sums = np.abs(state_tensors).reshape(len(state_tensors), -1).sum(axis=1, keepdims=True)
+        policy = np.sin(np.arange(len(uci_labels))[None, :] * 0.37 + sums).astype(np.float32)
+        return policy, np.tanh(np.cos(sums * 0.11)).astype(np.float32)
+
+
+def test_root_parallel():
+    with RootParallelMcst(_SinModel(), num_workers=3, batch_size=8) as mcst:
+        node = mcst.start(ChineseChessBoard(), 300)
+        assert mcst.root.visits == 300
+        assert sum(visits for _, _, visits, _ in mcst.children) == 300
+        assert node.visits == max(visits for _, _, visits, _ in mcst.children)
+
+        # 换根之后各进程保留的访问次数合在一起, 接着搜索
+        mcst.update_root(node.source, node.target)
+        kept = mcst.root.visits
+        assert 0 < kept < 300
+        mcst.search(90)
+        assert mcst.root.visits == kept + 90
+        assert mcst.root_board.zobrist_key == node.board.zobrist_key
+
+        # aiplay 用的限时搜索接口, 保留的访问次数也计入
+        node = mcst.anytime_search(60, time_limit=5)
+        assert node is not None and kept + 90 < mcst.root.visits <= kept + 150
+        node = mcst.anytime_start(ChineseChessBoard(), time_limit=0.2)
+        assert node is not None and mcst.root.visits > 0
+
+
+def test_board_message():
+    import pickle
+
+    # 长局的局面历史很深, 发给子进程的只有局面和判重复要看的几步
+    board = ChineseChessBoard()
+    shuffle = [((0, 1), (2, 2)), ((9, 1), (7, 2)), ((2, 2), (0, 1)), ((7, 2), (9, 1))]
+    for move in shuffle * 250:
+        board.make_move(*move)
+    board.num_steps_no_capture = 9
+    message = pickle.loads(pickle.dumps(_board_message(board)))
+    copied = _board_from_message(*message)
+    assert copied.zobrist_key == board.zobrist_key and copied.is_red_turn == board.is_red_turn
+    assert copied.num_steps_no_capture == 9 and len(message[3]) == 9
+    assert copied.repetition_result() == board.repetition_result() == 'draw'
+    assert sorted(copied.legal_moves()) == sorted(board.legal_moves())
+
+
+if __name__ == '__main__':
+    test_root_parallel()
+    test_board_message()
@@ -0,0 +1,139 @@
+import json
+import math
+import threading
+import time
+from collections import Counter
+
+PHASES = ('select', 'movegen', 'encode', 'predict', 'backprop')
+
+# 网络延迟直方图的上界 (毫秒), 最后一格是更慢的
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _bucket_label(i):
+    if i < len(LATENCY_BUCKETS_MS):
+        return '<=%g' % LATENCY_BUCKETS_MS[i]
+    return '>%g' % LATENCY_BUCKETS_MS[-1]
+
+
+class SearchStats:
+    """Counters and timers filled in by mcstx.Mcst when passed as Mcst(..., search_stats=SearchStats()).
+
+    Phase times are exclusive: select does not include the move generation, encoding and predict of the
+    leaves it expands. With log_file set, a JSON line of snapshot() is written every log_interval seconds.
+    """
+
+    def __init__(self, log_file=None, log_interval=10.0):
+        self.log_file = log_file
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+            self.phase_calls = dict.fromkeys(PHASES, 0)
+            self.simulations = 0
+            self.search_seconds = 0.0
+            self.batch_sizes = Counter()
+            self.latency_histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+            self.depth_total = 0
+            self.max_depth = 0
+            self.expansions = 0
+            self.children_total = 0
+            self.num_nodes = 0
+            self._last_log = time.monotonic()
+
+    def inner_seconds(self):
+        # 当前线程记下的阶段时间总和, select 用它扣掉展开叶子花的时间
+        return getattr(self._local, 'seconds', 0.0)
+
+    def add_phase(self, phase, seconds):
+        self._local.seconds = self.inner_seconds() + seconds
+        with self._lock:
+            self.phase_seconds[phase] += seconds
+            self.phase_calls[phase] += 1
+
+    def add_predict(self, rows, seconds):
+        self.add_phase('predict', seconds)
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if seconds * 1000 <= bound),
+                      len(LATENCY_BUCKETS_MS))
+        with self._lock:
+            self.batch_sizes[rows] += 1
+            self.latency_histogram[bucket] += 1
+
+    def add_expansion(self, num_children):
+        with self._lock:
+            self.expansions += 1
+            self.children_total += num_children
+
+    def add_simulation(self, depth):
+        with self._lock:
+            self.simulations += 1
+            self.depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def add_search(self, seconds, num_nodes):
+        with self._lock:
+            self.search_seconds += seconds
+            self.num_nodes = num_nodes
+
+    def snapshot(self):
+        with self._lock:
+            predict_calls = self.phase_calls['predict']
+            rows = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                'time': time.time(),
+                'simulations': self.simulations,
+                'simulations_per_second': self.simulations / self.search_seconds if self.search_seconds else 0.0,
+                'search_seconds': self.search_seconds,
+                'phase_seconds': dict(self.phase_seconds),
+                'predict_calls': predict_calls,
+                'mean_batch_size': rows / predict_calls if predict_calls else 0.0,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'mean_predict_ms': self.phase_seconds['predict'] * 1000 / predict_calls if predict_calls else 0.0,
+                'predict_latency_ms': {_bucket_label(i): count for i, count in enumerate(self.latency_histogram)
+                                       if count},
+                'mean_depth': self.depth_total / self.simulations if self.simulations else 0.0,
+                'max_depth': self.max_depth,
+                'branching_factor': self.children_total / self.expansions if self.expansions else 0.0,
+                'num_nodes': self.num_nodes,
+            }
+
+    def maybe_log(self):
+        if self.log_file is None or time.monotonic() - self._last_log < self.log_interval:
+            return
+        self.log()
+
+    def log(self):
+        self._last_log = time.monotonic()
+        self.log_file.write(json.dumps(self.snapshot()) + '\n')
+        self.log_file.flush()
+
+
+def test_search_stats():
+    import io
+
+    log_file = io.StringIO()
+    stats = SearchStats(log_file, log_interval=0)
+    stats.add_phase('select', 0.5)
+    stats.add_predict(16, 0.003)
+    stats.add_predict(8, 2.0)
+    stats.add_expansion(40)
+    stats.add_simulation(3)
+    stats.add_simulation(5)
+    stats.add_search(2.0, 123)
+    assert math.isclose(stats.inner_seconds(), 2.503)
+
+    stats.maybe_log()
+    line = json.loads(log_file.getvalue())
+    assert line['simulations'] == 2 and line['simulations_per_second'] == 1.0
+    assert line['mean_batch_size'] == 12 and line['batch_sizes'] == {'8': 1, '16': 1}
+    assert line['predict_latency_ms'] == {'<=4': 1, '>1024': 1}
+    assert line['max_depth'] == 5 and line['mean_depth'] == 4 and line['branching_factor'] == 40
+    assert math.isclose(line['phase_seconds']['predict'], 2.003) and line['num_nodes'] == 123
+
+
+if __name__ == '__main__':
+    test_search_stats()
@@ -1,14 +1,26 @@
 import multiprocessing
-import subprocess
 
+from tensorflow.keras.models import load_model
 
-def worker():
-    subprocess.call(["E:\\myprojects\\alphachess\\venv\\Scripts\\python", "aiplay.py"])
+from aiplay import ai_play
+from inference import InferenceServer
+
+
+def worker(client):
+    # 子进程不加载模型, 通过 client 把请求发给主进程里的推理服务
+    ai_play(client, 10, 1000, "records/record")
 
 
 if __name__ == "__main__":
+    server = InferenceServer(load_model('model_wukong_arena_20epoch.h5'))
+
     jobs = []
     for i in range(2):
-        p = multiprocessing.Process(target=worker)
+        p = multiprocessing.Process(target=worker, args=(server.client(for_process=True),))
         jobs.append(p)
         p.start()
+
+    server.start()
+    for p in jobs:
+        p.join()
+    server.stop()
@@ -0,0 +1,407 @@
+import json
+import struct
+import sys
+import time
+
+import numpy as np
+
+from ChineseChessBoard import (ChineseChessBoard, EMPTY, ROOK, KING, ADVISOR, BISON, PAWN, INITIAL_SQUARES,
+                               PIECE_TO_CHAR, CHAR_TO_PIECE, KING_MOVES, ADVISOR_MOVES, BISON_MOVES, PAWN_MOVES,
+                               SQUARE_TO_POS, MAX_STEPS_NO_CAPTURE)
+
+# 文件格式: MAGIC, 4 字节头长度, JSON 头 {子力: [偏移, 局面数]}, 之后是各个子力的表, 每个局面一个字节
+MAGIC = b'CCTB'
+
+# 表里的取值: 0 和棋, 1 不可能出现的局面, 其余是 步数 + 2, 步数为奇数时走子方胜, 偶数时走子方负
+DRAW = 0
+ILLEGAL = 1
+MAX_DEPTH = 255 - 2
+
+# 车对士象, 兵对士象等常见的少子残局, 需要的更小的子力会一起生成
+DEFAULT_MATERIALS = (
+    'KRvK', 'KNvK', 'KCvK', 'KPvK',
+    'KRvKA', 'KRvKB', 'KRvKAA', 'KRvKBB', 'KRvKAB',
+    'KNvKA', 'KNvKB', 'KCvKA', 'KCvKB',
+    'KPvKA', 'KPvKB', 'KPPvK', 'KPPvKA', 'KPPvKB',
+)
+
+
+def _reachable_squares(piece):
+    # 棋子从开局位置出发能到达的方格; 车马炮哪里都能去
+    kind = abs(piece)
+    is_black = piece < 0
+    if kind not in (KING, ADVISOR, BISON, PAWN):
+        return list(range(90))
+    steps = {KING: KING_MOVES, ADVISOR: ADVISOR_MOVES, PAWN: PAWN_MOVES}.get(kind)
+    frontier = [sq for sq, initial in enumerate(INITIAL_SQUARES) if initial == piece]
+    seen = set(frontier)
+    while frontier:
+        sq = frontier.pop()
+        if steps is None:
+            targets = [dst for dst, _ in BISON_MOVES[is_black][sq]]
+        else:
+            targets = steps[is_black][sq]
+        for dst in targets:
+            if dst not in seen:
+                seen.add(dst)
+                frontier.append(dst)
+    return sorted(seen)
+
+
+# 每种棋子可能在的方格, 以及方格 -> 在其中的序号 (不可能时为 -1)
+PIECE_SQUARES = {piece: _reachable_squares(piece) for piece in PIECE_TO_CHAR if piece != EMPTY}
+SQUARE_INDEX = {}
+for _piece, _squares in PIECE_SQUARES.items():
+    SQUARE_INDEX[_piece] = np.full(90, -1, dtype=np.intp)
+    SQUARE_INDEX[_piece][_squares] = np.arange(len(_squares))
+
+
+def material_slots(material):
+    """Pieces of a material key such as 'KRvKAA', in index order: both kings, then red, then black."""
+    red, black = material.split('v')
+    red = sorted(CHAR_TO_PIECE[char] for char in red if char != 'K')
+    black = sorted((-CHAR_TO_PIECE[char] for char in black if char != 'K'), key=abs)
+    return [KING, -KING] + red + black
+
+
+def normalize_material(material):
+    # 与 ChineseChessBoard.material_key 一样按棋子编码排序, 'KRvKAB' -> 'KRvKBA'
+    return 'v'.join('K' + ''.join(sorted(side.replace('K', ''), key=CHAR_TO_PIECE.get))
+                    for side in material.split('v'))
+
+
+def flip_material(material):
+    # 红黑互换之后的子力
+    red, black = material.split('v')
+    return black + 'v' + red
+
+
+def _flip_board(board):
+    # 上下翻转并交换红黑, 走子方也交换, 对走子方来说结果不变
+    squares = [EMPTY] * 90
+    for sq, piece in enumerate(board.squares):
+        if piece != EMPTY:
+            squares[(9 - sq // 9) * 9 + sq % 9] = -piece
+    return ChineseChessBoard.from_squares(squares, not board.is_red_turn)
+
+
+def _table_shape(slots):
+    return (2,) + tuple(len(PIECE_SQUARES[piece]) for piece in slots)
+
+
+def position_index(board, slots):
+    # 局面在表里的下标; 相同的棋子按方格从小到大分配. 第一维是走子方, 红方走为 1
+    squares_by_piece = {}
+    for pieces in board._pieces:
+        for sq in sorted(pieces):
+            squares_by_piece.setdefault(pieces[sq], []).append(sq)
+    index = 1 if board.is_red_turn else 0
+    used = {}
+    for piece in slots:
+        n = used.get(piece, 0)
+        used[piece] = n + 1
+        index = index * len(PIECE_SQUARES[piece]) + SQUARE_INDEX[piece][squares_by_piece[piece][n]]
+    return int(index)
+
+
+def decode_value(value):
+    """('win' | 'loss' | 'draw', moves to mate or None) for the side to move, None for an impossible position."""
+    if value == ILLEGAL:
+        return None
+    if value == DRAW:
+        return 'draw', None
+    depth = int(value) - 2
+    return ('win' if depth % 2 else 'loss'), depth
+
+
+def probe_tables(tables, board):
+    """Looks a board up in {material: uint8 table}; black-strong positions are probed colour-flipped."""
+    material = board.material_key()
+    if material not in tables:
+        material = flip_material(material)
+        if material not in tables:
+            return None
+        board = _flip_board(board)
+    return decode_value(tables[material][position_index(board, material_slots(material))])
+
+
+def _dependencies(material):
+    # 吃掉一个子之后的子力
+    red, black = material.split('v')
+    materials = []
+    for i in range(1, len(red)):
+        materials.append(red[:i] + red[i + 1:] + 'v' + black)
+    for i in range(1, len(black)):
+        materials.append(red + 'v' + black[:i] + black[i + 1:])
+    return sorted(set(materials))
+
+
+def _solve(material, tables):
+    # 逆向分析: 从被将死 (或困毙) 的局面往回一层层推, 推不到的局面是和棋
+    slots = material_slots(material)
+    shape = _table_shape(slots)
+    num_placements = int(np.prod(shape[1:]))
+    strides = [int(np.prod(shape[i + 2:])) for i in range(len(slots))]
+    coords = np.indices(shape[1:]).reshape(len(slots), -1)
+    placements = np.array([np.asarray(PIECE_SQUARES[piece])[coords[i]] for i, piece in enumerate(slots)])
+    distinct = np.ones(num_placements, dtype=bool)
+    for i in range(len(slots)):
+        for j in range(i):
+            distinct &= placements[i] != placements[j]
+
+    values = np.full(2 * num_placements, ILLEGAL, dtype=np.uint8)
+    remaining = np.zeros(2 * num_placements, dtype=np.int32)
+    results = np.zeros(2 * num_placements, dtype=np.int8)  # 1 走子方胜, -1 负, 0 还不知道
+    depths = np.zeros(2 * num_placements, dtype=np.int16)
+    edge_sources, edge_targets = [], []
+    # 吃子之后落到更小子力里的结果, 按那边的步数分层: 步数 -> [(局面, 后继局面走子方的胜负)]
+    captures = {}
+    # 没有棋可走, 被将死或困毙都算输
+    resolved = []
+
+    for placement in np.flatnonzero(distinct):
+        squares = [EMPTY] * 90
+        slot_of = {}
+        for i, piece in enumerate(slots):
+            sq = int(placements[i, placement])
+            squares[sq] = piece
+            slot_of[sq] = i
+        for is_red_turn in (False, True):
+            board = ChineseChessBoard.from_squares(squares, is_red_turn)
+            # 不走子的一方被将军是不可能的局面, 包括将帅照面
+            if board.is_in_check(not is_red_turn):
+                continue
+            index = (num_placements if is_red_turn else 0) + int(placement)
+            values[index] = DRAW
+            moves = board._legal_square_moves()
+            remaining[index] = len(moves)
+            if not moves:
+                results[index] = -1
+                resolved.append(index)
+            successor_turn = 0 if is_red_turn else num_placements
+            for src, dst in moves:
+                if squares[dst] != EMPTY:
+                    board._make_move(src, dst)
+                    result, depth = probe_tables(tables, board)
+                    board.unmake_move()
+                    if result != 'draw':
+                        captures.setdefault(depth, []).append((index, result))
+                else:
+                    i = slot_of[src]
+                    piece = slots[i]
+                    shift = (SQUARE_INDEX[piece][dst] - SQUARE_INDEX[piece][src]) * strides[i]
+                    edge_sources.append(index)
+                    edge_targets.append(successor_turn + int(placement) + int(shift))
+
+    # 反查表: 局面 q 的前驱是 predecessors[starts[q]:starts[q + 1]]
+    edge_sources = np.asarray(edge_sources, dtype=np.int64)
+    edge_targets = np.asarray(edge_targets, dtype=np.int64)
+    order = np.argsort(edge_targets, kind='stable')
+    predecessors = edge_sources[order]
+    starts = np.searchsorted(edge_targets[order], np.arange(2 * num_placements + 1))
+
+    # resolved 是第 depth 层刚定下来的局面, 由它们推出第 depth + 1 层
+    depth = 0
+    while resolved or captures:
+        events = captures.pop(depth, [])
+        events += [(int(p), 'win' if results[q] > 0 else 'loss')
+                   for q in resolved for p in predecessors[starts[q]:starts[q + 1]]]
+        resolved = []
+        for index, result in events:
+            if results[index]:
+                continue
+            if result == 'loss':
+                results[index] = 1
+            else:
+                # 所有走法都让对方赢, 才是输
+                remaining[index] -= 1
+                if remaining[index]:
+                    continue
+                results[index] = -1
+            depths[index] = depth + 1
+            resolved.append(index)
+        depth += 1
+        if resolved and depth > MAX_DEPTH:
+            raise ValueError(f'{material}: more than {MAX_DEPTH} moves to mate')
+
+    decided = results != 0
+    values[decided] = depths[decided] + 2
+    return values
+
+
+def solve(materials, tables=None):
+    """Solves the materials and the smaller ones they capture into; returns {material: uint8 table}."""
+    tables = {} if tables is None else tables
+    for material in map(normalize_material, materials):
+        if material in tables or flip_material(material) in tables:
+            continue
+        solve(_dependencies(material), tables)
+        started = time.time()
+        tables[material] = _solve(material, tables)
+        values = tables[material]
+        print(f'{material}: {len(values)} positions, {np.count_nonzero(values > ILLEGAL)} decided, '
+              f'longest {int(values.max()) - 2 if values.max() > ILLEGAL else 0} plies, '
+              f'{time.time() - started:.1f}s')
+    return tables
+
+
+def write_tablebase(path, tables):
+    header = {}
+    offset = 0
+    for material, values in tables.items():
+        header[material] = [offset, len(values)]
+        offset += len(values)
+    header = json.dumps(header).encode('ascii')
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        for values in tables.values():
+            f.write(np.ascontiguousarray(values, dtype=np.uint8).tobytes())
+
+
+def build_tablebase(path, materials=DEFAULT_MATERIALS):
+    """Generates the materials (python tablebase.py PATH [MATERIAL ...]) and writes them to one file."""
+    write_tablebase(path, solve(materials))
+
+
+class Tablebase:
+    """Exact results of small endings, read from a file written by build_tablebase.
+
+    The file is memory-mapped, so only the pages that are probed are read and processes opening the same
+    file share them. Results are for the side to move; dtm counts plies. probe() ignores the board's draw
+    rules, winner(), value() and best_move() only answer when the result holds under them.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a tablebase file')
+            header_length, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_length))
+        data_offset = len(MAGIC) + 4 + header_length
+        self._data = np.memmap(path, dtype=np.uint8, mode='r', offset=data_offset) if header else None
+        self.tables = {material: self._data[offset:offset + size] for material, (offset, size) in header.items()}
+        # 子多于表里最多的局面不用算子力就知道不在表里, 搜索中每个叶子都要查
+        self.max_pieces = max((len(material) - 1 for material in self.tables), default=0)
+
+    def probe(self, board):
+        """('win' | 'loss' | 'draw', dtm) for the side to move, or None if the board is not covered."""
+        if len(board._pieces[0]) + len(board._pieces[1]) > self.max_pieces:
+            return None
+        return probe_tables(self.tables, board)
+
+    def result(self, board):
+        """probe() under the board's rules: None when the mate cannot come before the no-capture draw,
+        or when the position is already decided by repetition."""
+        result = self.probe(board)
+        if result is None:
+            return None
+        # 将死的那一步之后也不能到和棋的步数; 路上的吃子会重新计数, 这里按不吃子算, 宁可不用表
+        if result[1] is not None and board.num_steps_no_capture + result[1] >= MAX_STEPS_NO_CAPTURE:
+            return None
+        if board.repetition_result() is not None:
+            return None
+        return result
+
+    def winner(self, board):
+        # 'red', 'black', 'draw' 或 None
+        result = self.result(board)
+        if result is None:
+            return None
+        if result[0] == 'draw':
+            return 'draw'
+        return 'red' if (result[0] == 'win') == board.is_red_turn else 'black'
+
+    def value(self, board):
+        # 与网络的价值同号: 红胜 1, 黑胜 -1, 和 0
+        winner = self.winner(board)
+        return None if winner is None else {'red': 1, 'black': -1, 'draw': 0}[winner]
+
+    def best_move(self, board):
+        """((x, y), (x, y)) that keeps the result: the fastest win, the longest loss, or any drawing move."""
+        result = self.result(board)
+        if result is None:
+            return None
+        best, best_key = None, None
+        board = board.copy()
+        for src, dst in board._legal_square_moves():
+            board._make_move(src, dst)
+            reply = self.probe(board)
+            board.unmake_move()
+            if reply is None:
+                continue
+            if reply[0] == 'loss':
+                key = (2, -reply[1])
+            elif reply[0] == 'draw':
+                key = (1, 0)
+            else:
+                key = (0, reply[1])
+            if best_key is None or key > best_key:
+                best, best_key = (SQUARE_TO_POS[src], SQUARE_TO_POS[dst]), key
+        return best
+
+
+def test_tablebase():
+    import os
+    import tempfile
+
+    tables = solve(['KRvK'])
+    assert set(tables) == {'KRvK', 'KvK'}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'test.cctb')
+        write_tablebase(path, tables)
+        tablebase = Tablebase(path)
+        assert isinstance(tablebase.tables['KRvK'], np.memmap)
+
+        # 车在四路将军, 黑将只能走到旁边
+        squares = [EMPTY] * 90
+        squares[4], squares[84], squares[40] = -KING, KING, ROOK
+        board = ChineseChessBoard.from_squares(squares, is_red_turn=False)
+        assert board.material_key() == 'KRvK' and tablebase.max_pieces == 3
+        result, dtm = tablebase.probe(board)
+        assert result == 'loss' and dtm % 2 == 0 and tablebase.winner(board) == 'red'
+        assert tablebase.value(board) == 1
+
+        # 红方走的局面: 按最佳走法走, 黑方随便走, 正好按表上的步数将死
+        squares[40], squares[36] = EMPTY, ROOK
+        board = ChineseChessBoard.from_squares(squares, is_red_turn=True)
+        result, dtm = tablebase.probe(board)
+        assert result == 'win' and dtm % 2 == 1
+        for ply in range(dtm):
+            if board.is_red_turn:
+                move = tablebase.best_move(board)
+            else:
+                move = board.legal_moves()[0]
+            board.make_move(*move)
+            assert tablebase.probe(board) == (('win' if board.is_red_turn else 'loss'), dtm - ply - 1)
+        assert not board.legal_moves()
+
+        # 来不及在不吃子判和之前将死时, 不按表判胜负
+        slow = ChineseChessBoard.from_squares(squares, is_red_turn=True)
+        result, dtm = tablebase.probe(slow)
+        slow.num_steps_no_capture = MAX_STEPS_NO_CAPTURE - dtm - 1
+        assert tablebase.winner(slow) == 'red' and tablebase.value(slow) == 1
+        slow.num_steps_no_capture += 1
+        assert tablebase.probe(slow) == (result, dtm)
+        assert tablebase.winner(slow) is None and tablebase.value(slow) is None
+        assert tablebase.best_move(slow) is None
+
+        # 黑车对红帅是颜色翻转后的同一张表
+        flipped = _flip_board(board)
+        assert flipped.material_key() == 'KvKR' and tablebase.probe(flipped) == ('loss', 0)
+        assert tablebase.winner(flipped) == 'black'
+        assert tablebase.probe(ChineseChessBoard()) is None and tablebase.best_move(ChineseChessBoard()) is None
+
+        # 只剩两个将帅是和棋; 将帅照面时不该轮到这一方走
+        squares = [EMPTY] * 90
+        squares[3], squares[85] = -KING, KING
+        assert tablebase.probe(ChineseChessBoard.from_squares(squares, True)) == ('draw', None)
+        squares[85], squares[84] = EMPTY, KING
+        assert tablebase.probe(ChineseChessBoard.from_squares(squares, True)) is None
+        del tablebase
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        build_tablebase(sys.argv[1], sys.argv[2:] or DEFAULT_MATERIALS)
+    else:
+        test_tablebase()
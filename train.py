@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 from tensorflow.keras.callbacks import Callback
 from tensorflow.keras.models import load_model
 
+from encoder import record_to_tensor
 from net import create_chinese_chess_model
 
 # 定义优化器和损失函数
@@ -34,47 +35,9 @@ def split_input_line(line):
     return board_state, move, outcome, player
 
 
-def to_tensor(line):
+def to_tensor(line, out=None):
     board_state, move, outcome, turn = split_input_line(line)
-
-    piece_to_onehot = {
-        'R': np.array([1, 0, 0, 0, 0, 0, 0]),
-        'N': np.array([0, 1, 0, 0, 0, 0, 0]),
-        'B': np.array([0, 0, 1, 0, 0, 0, 0]),
-        'A': np.array([0, 0, 0, 1, 0, 0, 0]),
-        'K': np.array([0, 0, 0, 0, 1, 0, 0]),
-        'C': np.array([0, 0, 0, 0, 0, 1, 0]),
-        'P': np.array([0, 0, 0, 0, 0, 0, 1]),
-        'r': np.array([-1, 0, 0, 0, 0, 0, 0]),
-        'n': np.array([0, -1, 0, 0, 0, 0, 0]),
-        'b': np.array([0, 0, -1, 0, 0, 0, 0]),
-        'a': np.array([0, 0, 0, -1, 0, 0, 0]),
-        'k': np.array([0, 0, 0, 0, -1, 0, 0]),
-        'c': np.array([0, 0, 0, 0, 0, -1, 0]),
-        'p': np.array([0, 0, 0, 0, 0, 0, -1]),
-        '_': np.array([0, 0, 0, 0, 0, 0, 0])
-    }
-
-    # create an empty tensor
-    tensor = np.zeros((10, 9, 9))  # the dimension of the tensor is (10, 9, 9)
-
-    # fill in the tensor with one-hot encoding of the pieces
-    for i in range(10):
-        for j in range(9):
-            tensor[i, j, :7] = piece_to_onehot[board_state[i * 9 + j]]
-
-    # fill in the tensor with the last move
-    if move is not None:
-        source, target = move
-        if source is not None and target is not None:
-            if source[0] != -1 and source[1] != -1 and target[0] != -1 and target[1] != -1:
-                tensor[source[0], source[1], 7] = -1
-                tensor[target[0], target[1], 7] = 1
-
-    # fill in the tensor with the current turn
-    tensor[:, :, 8] = turn
-
-    return tensor, outcome
+    return record_to_tensor(board_state, move, turn, out), outcome
 
 
 # 创建模型
@@ -82,16 +45,14 @@ model = load_model("model_wukong_v16.h5")
 model.compile(optimizer=optimizer, loss=loss_fn)
 
 # 读取和准备数据
-data = []
-labels = []
 with open('E:\\myprojects\\crawl\\ccbridge_arena\\qipu_from_ccbridge_arena_result.txt', 'r') as f:
-    for line in f:
-        input_data, label = to_tensor(line)
-        data.append(input_data)
-        labels.append(label)
+    lines = f.readlines()
 
-data = np.array(data)
-labels = np.array(labels)
+# 每个样本直接编码进预先分配好的 float32 数组
+data = np.empty((len(lines), 10, 9, 9), dtype=np.float32)
+labels = np.empty(len(lines), dtype=np.float32)
+for i, line in enumerate(lines):
+    _, labels[i] = to_tensor(line, data[i])
 
 
 class PlotLosses(Callback):